@@ -0,0 +1,82 @@
+# Purpose: Synthetic billboards (and the external synthdef/sample data NRT needs) of configurable size, for benchmarking.
+
+import random
+from dataclasses import dataclass
+
+from jdw_billboarding.lib.external_data_classes import Sample, SampleMessage, SynthDefMessage
+from jdw_billboarding.lib.jdw_osc_utils import create_msg
+
+NOTE_LETTERS = ["c", "d", "e", "f", "g", "a", "bb"]
+NOTE_TIMES = ["0.25", "0.5", "0.5", "1", "1.5"]
+EFFECT_TYPES = ["reverb", "delay", "clamp", "distortion"]
+
+@dataclass
+class BillboardSize:
+    sections: int = 8 # Regular synth sections
+    tracks: int = 4 # Per section
+    notes: int = 32 # Per track
+    samplers: int = 2
+    drones: int = 1
+    arrangement_rows: int = 64 # ">>>" filter rows
+    seed: int = 1
+
+def _synth_track(rnd: random.Random, notes: int) -> str:
+    elements = [rnd.choice(NOTE_LETTERS) + str(rnd.randint(3, 6)) + ":" + rnd.choice(NOTE_TIMES) for _ in range(notes)]
+    return "(" + " ".join(elements) + "):sus0.2,amp0.5,pan" + str(rnd.randint(-5, 5) / 10)
+
+def _sampler_track(rnd: random.Random, notes: int) -> str:
+    elements = [(str(rnd.randint(0, 20)) if rnd.random() > 0.25 else "x") + ":" + rnd.choice(NOTE_TIMES) for _ in range(notes)]
+    return "(" + " ".join(elements) + ")"
+
+def _drone_track(rnd: random.Random, notes: int) -> str:
+    elements = [rnd.choice(NOTE_LETTERS) + str(rnd.randint(4, 6)) + ":" + rnd.choice(NOTE_TIMES) for _ in range(max(1, notes // 4))]
+    return "(" + " ".join(elements) + "):amp0.3"
+
+def group_names(size: BillboardSize) -> list[str]:
+    return ["syn" + str(i) for i in range(size.sections)] \
+        + ["smp" + str(i) for i in range(size.samplers)] \
+        + ["drn" + str(i) for i in range(size.drones)]
+
+def generate_billboard(size: BillboardSize) -> str:
+    rnd = random.Random(size.seed)
+    groups = group_names(size)
+
+    lines: list[str] = ["COMMAND /set_bpm 120", "COMMAND /set_scale c maj 4", "DEFAULT amp1,ofs0", ""]
+
+    for _ in range(size.arrangement_rows):
+        lines.append(">>> " + " ".join(rnd.sample(groups, rnd.randint(1, len(groups)))))
+    lines.append("")
+
+    for i in range(size.sections):
+        selection = "*" if i == 0 else ""
+        lines.append(selection + "@synth" + str(i % 4) + ":syn" + str(i) + " sus0.3,out" + str(i % 8 * 2))
+        lines += ["    " + _synth_track(rnd, size.notes) for _ in range(size.tracks)]
+        lines.append("    €" + rnd.choice(EFFECT_TYPES) + ":a mix0.3")
+        lines.append("")
+
+    for i in range(size.samplers):
+        lines.append("@SP_pack" + str(i) + ":smp" + str(i) + " ofs0,sus20,amp0.6 1:0 2:14")
+        lines += ["    " + _sampler_track(rnd, size.notes) for _ in range(size.tracks)]
+        lines.append("")
+
+    for i in range(size.drones):
+        lines.append("@DR_pad" + str(i) + ":drn" + str(i) + " amp0.0,out90")
+        lines += ["    " + _drone_track(rnd, size.notes) for _ in range(size.tracks)]
+        lines.append("    €reverb:a room0.9,mix0.35")
+        lines.append("")
+
+    return "\n".join(lines)
+
+def generate_synthdefs(size: BillboardSize) -> list[SynthDefMessage]:
+    names = ["synth" + str(i) for i in range(4)] + ["pad" + str(i) for i in range(size.drones)] \
+        + EFFECT_TYPES + ["sampler", "router"]
+    return [SynthDefMessage("", name, create_msg("/load_synthdef", [name])) for name in names]
+
+def generate_samples(size: BillboardSize, per_pack: int = 1000) -> list[SampleMessage]:
+    samples: list[SampleMessage] = []
+    categories = ["", "bd", "sn", "hh"]
+    for pack in range(size.samplers):
+        for i in range(per_pack):
+            sample = Sample("/samples/" + str(i) + ".wav", "pack" + str(pack), len(samples), categories[i % 4], i // 4)
+            samples.append(SampleMessage(sample, create_msg("/load_sample", sample.as_args())))
+    return samples
@@ -0,0 +1,139 @@
+# Purpose: Timing each stage of the parse -> OSC pipeline on synthetic billboards, storing results as JSON so that
+#   runs from different commits can be compared.
+#
+# Usage (from the repository root):
+#   python -m benchmarks.run_benchmarks --output bench_before.json
+#   python -m benchmarks.run_benchmarks --output bench_after.json --compare bench_before.json
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from typing import Any, Callable
+
+from benchmarks.billboard_generators import BillboardSize, generate_billboard, generate_samples, generate_synthdefs
+from jdw_billboarding.lib.billboard_classes import Billboard
+from jdw_billboarding.lib.billboard_construction import parse_billboard, parse_billboard_file, process_synth_section
+from jdw_billboarding.lib.billboard_file import BillboardFile
+from jdw_billboarding.lib.billboard_running import get_nrt_data, get_queue_update_packets
+from jdw_billboarding.lib.element_osc_conversion import ScaleData
+from jdw_billboarding.lib.filtering import extract_default_args, extract_synth_chunks
+from jdw_billboarding.lib.line_classify import classify_lines
+from jdw_billboarding.lib.nrt_scoring import Score
+from jdw_billboarding.lib.parsing import clear_parse_track_cache, parse_synth_chunk
+
+# Runs are cold unless warm is set: the track parse cache is cleared first, so that shuttle parsing is measured too
+def _time(fn: Callable[[], Any], repeat: int, warm: bool = False) -> dict[str, float | int]:
+    timings: list[float] = []
+    for _ in range(repeat):
+        if not warm:
+            clear_parse_track_cache()
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return {"min_s": min(timings), "median_s": statistics.median(timings), "runs": repeat}
+
+def _build_score(billboard: Billboard) -> Score:
+    score = Score()
+    for sec in billboard.sections:
+        for track_name in sec.tracks:
+            score.add_source(track_name, sec.tracks[track_name].group_name, sec.tracks[track_name].messages)
+    for filter_set in billboard.group_filters:
+        score.extend_groups(filter_set)
+    return score
+
+def run(size: BillboardSize, repeat: int, workers: int = 0) -> dict[str, dict[str, float | int]]:
+    content = generate_billboard(size)
+    synthdefs = generate_synthdefs(size)
+    samples = generate_samples(size)
+
+    # Intermediate results for the stages that take the output of a previous one
+    lines = classify_lines(content)
+    chunks = extract_synth_chunks(lines)
+    synth_sections = [parse_synth_chunk(chunk) for chunk in chunks]
+    default_args = extract_default_args(lines)
+    scale_data = ScaleData("c", "maj", 4)
+    billboard = parse_billboard(content)
+    score = _build_score(billboard)
+
+    results: dict[str, dict[str, float | int]] = {}
+    results["classify_lines"] = _time(lambda: classify_lines(content), repeat)
+    results["parse_synth_chunk"] = _time(lambda: [parse_synth_chunk(chunk) for chunk in chunks], repeat)
+    results["process_synth_section"] = _time(lambda: [process_synth_section(s, default_args, scale_data) for s in synth_sections], repeat)
+    results["parse_billboard"] = _time(lambda: parse_billboard(content), repeat)
+    # Every track already parsed once, as when re-parsing an edited billboard in the same process
+    parse_billboard(content)
+    results["parse_billboard_warm"] = _time(lambda: parse_billboard(content), repeat, warm=True)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        bbd_file = BillboardFile(temp_dir + "/benchmark.bbd")
+        with open(bbd_file.path, "w", encoding="utf-8") as output_file:
+            output_file.write(content)
+        results["parse_billboard_file"] = _time(lambda: parse_billboard_file(bbd_file), repeat)
+    results["get_queue_update_packets"] = _time(lambda: get_queue_update_packets(content), repeat)
+    results["score_extend_groups"] = _time(lambda: _build_score(billboard), repeat)
+    # Unpacking leaves the score untouched, so one built score serves every run
+    results["score_unpack_timed_tracks"] = _time(lambda: score.unpack_timed_tracks(), repeat)
+    results["get_nrt_data"] = _time(lambda: get_nrt_data(content, synthdefs, samples), repeat)
+
+    if workers > 0:
+        with ProcessPoolExecutor(workers) as executor:
+            results["parse_billboard_parallel"] = _time(lambda: parse_billboard(content, executor=executor), repeat)
+
+    return results
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def compare(current: dict[str, Any], previous: dict[str, Any]):
+    print("stage".ljust(28), "previous (ms)".rjust(14), "current (ms)".rjust(14), "ratio".rjust(8))
+    for stage in current["results"]:
+        if stage not in previous["results"]:
+            continue
+        prev_ms = previous["results"][stage]["median_s"] * 1000
+        cur_ms = current["results"][stage]["median_s"] * 1000
+        ratio = cur_ms / prev_ms if prev_ms > 0 else float("inf")
+        print(stage.ljust(28), ("%.3f" % prev_ms).rjust(14), ("%.3f" % cur_ms).rjust(14), ("%.2f" % ratio).rjust(8))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the billboard parse -> OSC pipeline")
+    parser.add_argument("--sections", type=int, default=BillboardSize.sections)
+    parser.add_argument("--tracks", type=int, default=BillboardSize.tracks)
+    parser.add_argument("--notes", type=int, default=BillboardSize.notes)
+    parser.add_argument("--samplers", type=int, default=BillboardSize.samplers)
+    parser.add_argument("--drones", type=int, default=BillboardSize.drones)
+    parser.add_argument("--rows", type=int, default=BillboardSize.arrangement_rows, help="Number of >>> arrangement rows")
+    parser.add_argument("--seed", type=int, default=BillboardSize.seed)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=0, help="Also time parse_billboard on a process pool of this size")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    args = parser.parse_args()
+
+    size = BillboardSize(args.sections, args.tracks, args.notes, args.samplers, args.drones, args.rows, args.seed)
+
+    report: dict[str, Any] = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "size": asdict(size),
+        "results": run(size, args.repeat, args.workers)
+    }
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            compare(report, json.load(previous_file))
+    else:
+        for stage in report["results"]:
+            print(stage.ljust(28), ("%.3f ms" % (report["results"][stage]["median_s"] * 1000)).rjust(14))
@@ -0,0 +1,41 @@
+# Purpose: Exact integer beat arithmetic for scoring.
+#   A beat is TICKS_PER_BEAT ticks: any decimal time with up to 12 decimals is a whole number of ticks, and so are
+#   thirds, sixths, sevenths and ninths of a beat (e.g. triplets written as 0.3333333333333333333333333333).
+
+from decimal import ROUND_HALF_EVEN, Decimal
+from functools import lru_cache
+
+TICKS_PER_BEAT: int = 63 * 10**12
+
+_TICKS_PER_BEAT_DECIMAL = Decimal(TICKS_PER_BEAT)
+
+# Cached, since note lengths come from a small set of values
+@lru_cache(maxsize=4096)
+def beats_to_ticks(beats: Decimal | float | int | str) -> int:
+    return int((Decimal(beats) * _TICKS_PER_BEAT_DECIMAL).to_integral_value(ROUND_HALF_EVEN))
+
+def ticks_to_beats(ticks: int) -> Decimal:
+    return Decimal(ticks) / _TICKS_PER_BEAT_DECIMAL
+
+# Plain decimal notation (no exponent, no trailing zeroes) as sent to jdw-sc
+# Cached, since the same few note lengths make up most of any song
+@lru_cache(maxsize=4096)
+def ticks_to_str(ticks: int) -> str:
+    return format(ticks_to_beats(ticks).normalize(), "f")
+
+# Tests
+if __name__ == "__main__":
+
+    assert beats_to_ticks("0.5") == TICKS_PER_BEAT // 2
+    assert beats_to_ticks(Decimal("1.50")) == beats_to_ticks(Decimal("1.5"))
+    assert ticks_to_str(beats_to_ticks("1.50")) == "1.5"
+    assert ticks_to_str(beats_to_ticks("10")) == "10"
+    assert ticks_to_str(beats_to_ticks("0.0")) == "0"
+    assert ticks_to_str(beats_to_ticks("0.000000000001")) == "0.000000000001"
+    assert beats_to_ticks(0.1) == beats_to_ticks("0.1")
+    assert beats_to_ticks(1 / 3) * 3 == TICKS_PER_BEAT
+
+    # Triplets add up exactly
+    third = beats_to_ticks(Decimal(1) / Decimal(3))
+    assert third * 3 == TICKS_PER_BEAT
+    assert sum([beats_to_ticks(Decimal(2) / Decimal(3))] * 3) == 2 * TICKS_PER_BEAT
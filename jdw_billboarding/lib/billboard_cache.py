@@ -0,0 +1,340 @@
+# Purpose: Compiled billboards on disk, so that restarts and renders of an unchanged .bbd skip parsing entirely.
+#   song.bbd.cache holds a header, a signature and the pickled Billboard, encoded OSC datagrams included. The header
+#   identifies everything the payload was built from: the .bbd content, the library (version and a digest of its source
+#   files, as the version is rarely bumped), the shuttle_notation and python-osc versions and the registered command
+#   handlers. A cache whose header doesn't match is ignored and rewritten on the next parse.
+#
+#   billboard = load_billboard(BillboardFile("song.bbd"))
+#   get_queue_update_packets(BillboardFile("song.bbd", use_cache=True))
+#
+# NOTE: Unpickling can run arbitrary code, and anyone can compute a matching header. Caches are therefore signed with
+#   an HMAC of a secret key private to the user (see cache_key_path), and a payload is only unpickled once its
+#   signature checks out. A cache written by anyone else, or with another key, is ignored like an outdated one.
+
+import hashlib
+import hmac
+import mmap
+import os
+import struct
+from functools import lru_cache, partial
+from types import CodeType
+from typing import TYPE_CHECKING, Any
+
+from jdw_billboarding.lib.billboard_classes import Billboard, BillboardSynthSection
+from jdw_billboarding.lib.billboard_commands import command_handlers
+from jdw_billboarding.lib.billboard_construction import SectionKey, parse_billboard_file
+from jdw_billboarding.lib.billboard_file import BillboardFile
+
+# Executor is only used in annotations, and importing concurrent.futures pulls in logging
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+CACHE_SUFFIX = ".cache"
+CACHE_MAGIC = b"JDWBBC\x00\x02" # Last byte is the format version
+CACHE_KEY_SIZE = 32
+
+_VERSION_LENGTH = struct.Struct(">H")
+_SIGNATURE_SIZE = hashlib.sha256().digest_size
+
+# NOTE: pickle, tempfile and importlib.metadata are imported where used: billboard_running imports this module, and
+#   they would take a good part of its import time budget while only being needed once a cache is actually used
+
+# Parsing and encoding results also depend on these, e.g. shuttle_notation's element resolution
+DEPENDENCIES = ["shuttle_notation", "python-osc"]
+
+@lru_cache(maxsize=None)
+def distribution_version(name: str) -> str:
+    import importlib.metadata
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        # E.g. running from a source checkout
+        return "unknown"
+
+def library_version() -> str:
+    return distribution_version("jdw_billboarding")
+
+# Digest of every source file of the package, so that changes to parsing or encoding invalidate existing caches
+@lru_cache(maxsize=1)
+def library_source_digest() -> bytes:
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    digest = hashlib.sha256()
+    for directory, subdirectories, files in os.walk(package_dir):
+        subdirectories.sort()
+        for file_name in sorted(files):
+            if file_name.endswith(".py"):
+                path = os.path.join(directory, file_name)
+                digest.update(os.path.relpath(path, package_dir).encode("utf-8") + b"\x00")
+                with open(path, "rb") as source_file:
+                    digest.update(source_file.read())
+    return digest.digest()
+
+def _value_fingerprint(value: Any, seen: set[int]) -> bytes:
+    if isinstance(value, CodeType):
+        return _code_fingerprint(value, seen)
+    elif callable(value):
+        return _function_fingerprint(value, seen)
+    elif isinstance(value, (tuple, list)):
+        return b"(" + b",".join([_value_fingerprint(item, seen) for item in value]) + b")"
+    elif isinstance(value, (frozenset, set)):
+        # Iteration order of e.g. strings changes with hash randomization
+        return b"{" + b",".join(sorted([_value_fingerprint(item, seen) for item in value])) + b"}"
+    elif isinstance(value, dict):
+        return b"{" + b",".join(sorted([_value_fingerprint(key, seen) + b":" + _value_fingerprint(item, seen) for key, item in value.items()])) + b"}"
+    # Anything else by repr; one that includes a memory address only means a cache that is never reused
+    return repr(value).encode("utf-8")
+
+# Bytecode, constants (nested functions included) and the global/attribute names it refers to, e.g. int vs float
+def _code_fingerprint(code: CodeType, seen: set[int]) -> bytes:
+    return code.co_code + _value_fingerprint(code.co_consts, seen) + repr(code.co_names).encode("utf-8")
+
+def _function_fingerprint(function: Any, seen: set[int] | None = None) -> bytes:
+    seen = seen if seen != None else set()
+    # Functions referring to themselves, e.g. recursion through a closure
+    if id(function) in seen:
+        return b"<recursive>"
+    seen.add(id(function))
+
+    if isinstance(function, partial):
+        return _function_fingerprint(function.func, seen) + _value_fingerprint((function.args, function.keywords), seen)
+    code = getattr(function, "__code__", None)
+    if code == None:
+        return repr(getattr(function, "__qualname__", function)).encode("utf-8")
+
+    closure_values = []
+    for cell in function.__closure__ or ():
+        try:
+            closure_values.append(cell.cell_contents)
+        except ValueError:
+            # Not assigned yet
+            closure_values.append(None)
+    return _code_fingerprint(code, seen) + _value_fingerprint((function.__defaults__, function.__kwdefaults__, closure_values), seen)
+
+# Command values (and their messages) are resolved by the registered handlers, which users can replace or add to
+def command_handlers_digest() -> bytes:
+    digest = hashlib.sha256()
+    for address, handler in sorted(command_handlers().items()):
+        digest.update(address.encode("utf-8") + b"\x00")
+        digest.update(_function_fingerprint(handler.parse) + b"\x00")
+        digest.update(_function_fingerprint(handler.to_messages) + b"\x00")
+    return digest.digest()
+
+def cache_path(bbd_path: str) -> str:
+    return bbd_path + CACHE_SUFFIX
+
+def cache_key_path() -> str:
+    config_dir = os.environ.get("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config")
+    return os.path.join(config_dir, "jdw_billboarding", "cache.key")
+
+def _read_cache_key(path: str) -> bytes:
+    with open(path, "rb") as key_file:
+        key_stat = os.fstat(key_file.fileno())
+        # A key that others can read (or replace) could be used to sign a cache for you
+        if hasattr(os, "getuid") and (key_stat.st_uid != os.getuid() or key_stat.st_mode & 0o077 != 0):
+            raise PermissionError("cache key must only be accessible by its owner: " + path)
+        key = key_file.read()
+    if len(key) != CACHE_KEY_SIZE:
+        raise ValueError("cache key has the wrong size: " + path)
+    return key
+
+# The user's cache signing key, created on first use; None (and caching disabled) if it can't be read or created
+def cache_key() -> bytes | None:
+    import tempfile
+
+    path = cache_key_path()
+    try:
+        try:
+            return _read_cache_key(path)
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        # Written in full before being linked into place, so that concurrent first uses agree on a single key
+        file_descriptor, temp_path = tempfile.mkstemp(prefix="cache.key", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(file_descriptor, "wb") as temp_file:
+                temp_file.write(os.urandom(CACHE_KEY_SIZE))
+            try:
+                os.link(temp_path, path)
+            except FileExistsError:
+                pass
+        finally:
+            os.remove(temp_path)
+        return _read_cache_key(path)
+    except (OSError, ValueError) as e:
+        print("WARN: billboard caching disabled, no usable cache key:", e)
+        return None
+
+def _signature(key: bytes, header: bytes, payload: bytes | memoryview) -> bytes:
+    signature = hmac.new(key, header, hashlib.sha256)
+    signature.update(payload)
+    return signature.digest()
+
+def file_sha256(path: str) -> bytes:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size > 0:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+    return digest.digest()
+
+def _header(content_sha256: bytes) -> bytes:
+    versions = b""
+    for name in ["jdw_billboarding"] + DEPENDENCIES:
+        version = distribution_version(name).encode("utf-8")
+        versions += _VERSION_LENGTH.pack(len(version)) + version
+    return CACHE_MAGIC + versions + library_source_digest() + command_handlers_digest() + content_sha256
+
+# Returns False (and leaves any existing cache alone) if the billboard can't be pickled or the file can't be written
+def write_billboard_cache(path: str, content_sha256: bytes, billboard: Billboard) -> bool:
+    import pickle
+    import tempfile
+
+    key = cache_key()
+    if key == None:
+        return False
+
+    try:
+        payload = pickle.dumps(billboard, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        print("WARN: billboard could not be cached:", e)
+        return False
+    header = _header(content_sha256)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        # Written next to the target and moved into place, so that readers never see half a cache
+        file_descriptor, temp_path = tempfile.mkstemp(prefix=os.path.basename(path), dir=directory)
+        try:
+            with os.fdopen(file_descriptor, "wb") as temp_file:
+                temp_file.write(header)
+                temp_file.write(_signature(key, header, payload))
+                temp_file.write(payload)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    except OSError as e:
+        print("WARN: billboard cache could not be written:", e)
+        return False
+    return True
+
+# None if there is no cache for exactly this content, library and set of command handlers, signed with the user's key
+def read_billboard_cache(path: str, content_sha256: bytes) -> Billboard | None:
+    import pickle
+
+    header = _header(content_sha256)
+    payload_start = len(header) + _SIGNATURE_SIZE
+    try:
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size <= payload_start:
+                return None
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if mapped[:len(header)] != header:
+                    return None
+                key = cache_key()
+                if key == None:
+                    return None
+                with memoryview(mapped)[payload_start:] as payload:
+                    if not hmac.compare_digest(mapped[len(header):payload_start], _signature(key, header, payload)):
+                        print("WARN: ignoring billboard cache with an invalid signature:", path)
+                        return None
+                    billboard = pickle.loads(payload)
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, IndexError, TypeError, ValueError) as e:
+        print("WARN: ignoring unreadable billboard cache:", path, e)
+        return None
+
+    return billboard if isinstance(billboard, Billboard) else None
+
+"""
+    The billboard of a file from its cache if the content is unchanged, otherwise parsed and cached for next time.
+    The section cache and executor are only used when parsing.
+"""
+def load_billboard(billboard_file: BillboardFile, section_cache: dict[SectionKey, BillboardSynthSection] | None = None, executor: "Executor | None" = None) -> Billboard:
+    target = cache_path(billboard_file.path)
+    signature = billboard_file.signature()
+    content_sha256 = file_sha256(billboard_file.path)
+
+    billboard = read_billboard_cache(target, content_sha256)
+    if billboard != None:
+        return billboard
+
+    billboard = parse_billboard_file(billboard_file, section_cache, executor)
+    # A file edited while it was being parsed can't be trusted to match the hash
+    if billboard_file.signature() == signature:
+        write_billboard_cache(target, content_sha256, billboard)
+    return billboard
+
+# Tests
+if __name__ == "__main__":
+
+    import tempfile
+
+    from jdw_billboarding.lib.billboard_classes import BillboardCommand, CommandContext
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.environ["XDG_CONFIG_HOME"] = os.path.join(temp_dir, "config")
+        path = os.path.join(temp_dir, "song.bbd")
+        billboard = Billboard([], [["a", "b"]], [BillboardCommand("/set_bpm", CommandContext.ALL, ["90"], 90)], {"/set_bpm": 90})
+        content_sha256 = hashlib.sha256(b"content").digest()
+
+        assert read_billboard_cache(cache_path(path), content_sha256) == None
+        assert write_billboard_cache(cache_path(path), content_sha256, billboard)
+        assert read_billboard_cache(cache_path(path), content_sha256) == billboard
+        assert read_billboard_cache(cache_path(path), hashlib.sha256(b"edited").digest()) == None
+
+        # A changed command handler can resolve different values, so the cache no longer applies
+        from jdw_billboarding.lib.billboard_commands import register_command, get_command_handler
+        original = get_command_handler("/set_bpm")
+        assert original != None
+        register_command("/set_bpm", lambda args: int(args[0]) * 2, original.to_messages)
+        assert read_billboard_cache(cache_path(path), content_sha256) == None
+        register_command("/set_bpm", original.parse, original.to_messages)
+        assert read_billboard_cache(cache_path(path), content_sha256) == billboard
+
+        # Handlers differing only in the functions they call, their defaults or what they close over
+        assert _function_fingerprint(lambda args: int(args[0])) != _function_fingerprint(lambda args: float(args[0]))
+        assert _function_fingerprint(lambda args, scale=2: int(args[0]) * scale) != _function_fingerprint(lambda args, scale=3: int(args[0]) * scale)
+        def make_parse(scale: int):
+            return lambda args: int(args[0]) * scale
+        assert _function_fingerprint(make_parse(2)) != _function_fingerprint(make_parse(3))
+        assert _function_fingerprint(make_parse(2)) == _function_fingerprint(make_parse(2))
+        def make_nested(cast):
+            return lambda args: [cast(arg) for arg in args]
+        assert _function_fingerprint(make_nested(int)) != _function_fingerprint(make_nested(float))
+        assert _function_fingerprint(partial(make_parse(2), ["1"])) != _function_fingerprint(partial(make_parse(2), ["2"]))
+
+        # Tampered payload, e.g. a cache written by someone else with a matching header
+        with open(cache_path(path), "rb") as cache_file:
+            cache_bytes = cache_file.read()
+        with open(cache_path(path), "wb") as cache_file:
+            cache_file.write(cache_bytes[:-1] + bytes([cache_bytes[-1] ^ 1]))
+        assert read_billboard_cache(cache_path(path), content_sha256) == None
+        with open(cache_path(path), "wb") as cache_file:
+            cache_file.write(cache_bytes)
+        assert read_billboard_cache(cache_path(path), content_sha256) == billboard
+
+        # Signed with another key
+        assert cache_key() == cache_key()
+        os.remove(cache_key_path())
+        assert read_billboard_cache(cache_path(path), content_sha256) == None
+        assert write_billboard_cache(cache_path(path), content_sha256, billboard)
+        assert read_billboard_cache(cache_path(path), content_sha256) == billboard
+
+        # A key others can access is not trusted
+        if hasattr(os, "getuid"):
+            os.chmod(cache_key_path(), 0o644)
+            assert cache_key() == None
+            assert read_billboard_cache(cache_path(path), content_sha256) == None
+            os.chmod(cache_key_path(), 0o600)
+
+        # Truncated payload
+        with open(cache_path(path), "r+b") as cache_file:
+            cache_file.truncate(os.path.getsize(cache_path(path)) - 4)
+        assert read_billboard_cache(cache_path(path), content_sha256) == None
+
+        with open(path, "w") as bbd_file:
+            bbd_file.write("")
+        assert file_sha256(path) == hashlib.sha256(b"").digest()
@@ -4,32 +4,37 @@ from shuttle_notation import ResolvedElement
 from pythonosc.osc_message import OscMessage
 from enum import Enum
 from decimal import Decimal
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Any
+
+from jdw_billboarding.lib.beat_ticks import beats_to_ticks
 
 class CommandContext(Enum):
     UPDATE = 0
     QUEUE = 1
     ALL = 2
 
-@dataclass
+@dataclass(slots=True)
 class BillboardCommand:
     address: str
     context: CommandContext
     args: list[str]
+    # Args parsed by the handler registered for the address (see billboard_commands), None if there is none
+    value: Any = None
 
-@dataclass
+@dataclass(slots=True)
 class EffectMessage:
     effect: EffectDefinition
     external_id: str
     synth_name: str
     osc_args: list[str | float]
 
-@dataclass
+@dataclass(slots=True)
 class PadConfig:
     pad_number: int
     configured_index: int
 
-@dataclass
+@dataclass(slots=True)
 class BillboardKeyConfiguration:
     instrument_name: str
     pads_config: list[PadConfig]
@@ -37,22 +42,27 @@ class BillboardKeyConfiguration:
     for_sampler: bool
 
 # Contains the original element and the message it was resolved as
-@dataclass
+@dataclass(slots=True)
 class ElementMessage:
     element: ResolvedElement
     osc: OscMessage
+    # Length in beat ticks, resolved once so that scoring never has to parse the time arg again
+    ticks: int = field(init=False)
+
+    def __post_init__(self):
+        self.ticks = beats_to_ticks(self.element.args["time"]) if "time" in self.element.args else 0
 
     def get_time(self) -> str:
         return str(self.element.args["time"]) if "time" in self.element.args else "0.0"
 
 
-@dataclass
+@dataclass(slots=True)
 class BillboardTrack:
     messages: list[ElementMessage]
     group_name: str
 
 
-@dataclass
+@dataclass(slots=True)
 class BillboardSynthSection:
     # By name
     tracks: dict[str, BillboardTrack]
@@ -61,11 +71,13 @@ class BillboardSynthSection:
     key_configuration: BillboardKeyConfiguration | None
     header: SynthHeader
 
-@dataclass
+@dataclass(slots=True)
 class Billboard:
     sections: list[BillboardSynthSection]
     group_filters: list[list[str]]
     commands: list[BillboardCommand]
+    # Value of the last command of each registered address, e.g. command_values["/set_bpm"] == 120
+    command_values: dict[str, Any] = field(default_factory=dict)
 
     def get_final_filter(self) -> list[str]:
         return self.group_filters[-1] if len(self.group_filters) > 0 else []
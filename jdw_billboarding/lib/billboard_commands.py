@@ -0,0 +1,72 @@
+# Purpose: Registry of COMMAND types by address.
+#   Each command's args are parsed into a typed value once, while parsing the billboard, and the value is what
+#   both parsing (e.g. /transpose, /set_scale) and OSC conversion (e.g. /set_bpm) read from then on.
+#   Register a handler to add a command type of your own:
+#
+#   register_command("/set_swing", lambda args: float(args[0]), lambda swing: [create_msg("/set_swing", [swing])])
+
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from pythonosc.osc_message import OscMessage
+
+from jdw_billboarding.lib.billboard_classes import BillboardCommand, CommandContext
+from jdw_billboarding.lib.element_osc_conversion import ScaleData
+from jdw_billboarding.lib.jdw_osc_utils import create_msg
+
+@dataclass(slots=True)
+class CommandHandler:
+    # Command args as written in the billboard -> typed value
+    parse: Callable[[list[str]], Any]
+    # Typed value -> messages sent to jdw-sc (None for commands that only affect parsing)
+    to_messages: Callable[[Any], list[OscMessage]] | None = None
+
+_COMMAND_HANDLERS: dict[str, CommandHandler] = {}
+
+# Replaces any existing handler for the address
+def register_command(address: str, parse: Callable[[list[str]], Any], to_messages: Callable[[Any], list[OscMessage]] | None = None):
+    _COMMAND_HANDLERS[address] = CommandHandler(parse, to_messages)
+
+def get_command_handler(address: str) -> CommandHandler | None:
+    return _COMMAND_HANDLERS.get(address)
+
+def command_handlers() -> dict[str, CommandHandler]:
+    return dict(_COMMAND_HANDLERS)
+
+# Typed value of a command; None for addresses without a handler
+def resolve_command_value(address: str, args: list[str]) -> Any:
+    handler = _COMMAND_HANDLERS.get(address)
+    return handler.parse(args) if handler != None else None
+
+def command_messages(command: BillboardCommand) -> list[OscMessage]:
+    handler = _COMMAND_HANDLERS.get(command.address)
+    if handler == None or handler.to_messages == None:
+        return []
+    return handler.to_messages(command.value)
+
+def _router_messages(in_out: tuple[float, float]) -> list[OscMessage]:
+    in_arg, out_arg = in_out
+    ext_id = "effect_router_" + str(in_arg) + "_" + str(out_arg)
+    return [create_msg("/note_on", ["router", ext_id, 0, "in", in_arg, "out", out_arg])]
+
+register_command("/set_bpm", lambda args: int(args[0]), lambda bpm: [create_msg("/set_bpm", [bpm])])
+register_command("/keyboard_octave", lambda args: int(args[0]), lambda octave: [create_msg("/keyboard_octave", [octave])])
+register_command("/keyboard_quantization", lambda args: args[0], lambda quantization: [create_msg("/keyboard_quantization", [quantization])])
+register_command("/create_router", lambda args: (float(args[0]), float(args[1])), _router_messages)
+register_command("/transpose", lambda args: int(args[0]))
+register_command("/set_scale", lambda args: ScaleData(str(args[0]), str(args[1]), int(args[2])))
+
+# Tests
+if __name__ == "__main__":
+
+    assert resolve_command_value("/set_bpm", ["90"]) == 90
+    assert resolve_command_value("/set_scale", ["d", "min", "3"]) == ScaleData("d", "min", 3)
+    assert resolve_command_value("/unknown", ["1"]) == None
+
+    router = BillboardCommand("/create_router", CommandContext.ALL, ["4", "0"], resolve_command_value("/create_router", ["4", "0"]))
+    assert command_messages(router)[0].params == ["router", "effect_router_4.0_0.0", 0, "in", 4.0, "out", 0.0]
+    assert command_messages(BillboardCommand("/transpose", CommandContext.ALL, ["2"], 2)) == []
+
+    register_command("/set_swing", lambda args: float(args[0]), lambda swing: [create_msg("/set_swing", [swing])])
+    swing = BillboardCommand("/set_swing", CommandContext.ALL, ["0.5"], resolve_command_value("/set_swing", ["0.5"]))
+    assert command_messages(swing)[0].params == [0.5]
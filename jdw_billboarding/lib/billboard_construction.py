@@ -1,4 +1,8 @@
+from itertools import repeat
+from typing import TYPE_CHECKING, Iterable, Iterator
+
 from jdw_billboarding.lib.billboard_classes import *
+from jdw_billboarding.lib.billboard_commands import get_command_handler, resolve_command_value
 from jdw_billboarding.lib.element_osc_conversion import ElementConverter, InstrumentType, ScaleData
 from jdw_billboarding.lib.jdw_osc_utils import args_as_osc
 from jdw_billboarding.lib.shuttle_hacks import parse_orphaned_args
@@ -9,6 +13,11 @@ from jdw_billboarding.lib.jdw_osc_utils import ElementMessage, args_as_osc, reso
 from jdw_billboarding.lib.parse_classes import SynthSection
 from jdw_billboarding.lib.line_classify import QUEUE_COMMAND_SYMBOL, UPDATE_COMMAND_SYMBOL
 from jdw_billboarding.lib.parsing import parse_track
+from jdw_billboarding.lib.instrumentation import timed, timed_iter
+
+# Executor is only used in annotations, and importing concurrent.futures pulls in logging
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
 
 def parse_pads_config(source_string: str) -> list[PadConfig]:
     elements = Parser().parse(source_string)
@@ -34,13 +43,14 @@ def parse_command(line: str) -> BillboardCommand:
         context = CommandContext.UPDATE
 
     args: list[str] = split[2:] if len(split) > 2 else []
-    return BillboardCommand(split[1], context, args)
+    return BillboardCommand(split[1], context, args, resolve_command_value(split[1], args))
 
 
 def parse_drone_header(header: SynthHeader) -> EffectDefinition:
     return EffectDefinition(header.instrument_name, "", header.default_args_string)
 
 
+@timed("process_synth_section")
 def process_synth_section(synth_section: SynthSection, billboard_default_args: str, scale_data: ScaleData, transpose_steps: int = 0) -> BillboardSynthSection:
 
     # Build a combined default arg string from both DEFAULT and synth header args, prioritizing synth header args
@@ -82,11 +92,7 @@ def process_synth_section(synth_section: SynthSection, billboard_default_args: s
         element_converter_for_track = ElementConverter(synth_section.header.instrument_name, str(track.index), instrument_type, hdrone_id, scale_data)
 
         elements = parse_track(track, full_default_args)
-        resolved: list[ElementMessage] = []
-        for element in elements:
-            msg = element_converter_for_track.resolve_message(element, transpose_steps)
-            if msg: # TODO: Not sure how to handle "is not none" here
-                resolved.append(msg)
+        resolved: list[ElementMessage] = element_converter_for_track.resolve_messages(elements, transpose_steps)
 
         group_name = track.group_override if track.group_override != "" else synth_section.header.group_name
         track_name = "_".join([synth_section.header.instrument_name, group_name, str(track.index)])
@@ -102,37 +108,109 @@ def process_synth_section(synth_section: SynthSection, billboard_default_args: s
 
 
 # TODO: Perhaps a bit out of scope
-from jdw_billboarding.lib.line_classify import classify_lines
+from jdw_billboarding.lib.billboard_file import BillboardFile
+from jdw_billboarding.lib.line_classify import BillboardLine, BillboardLineType, classify_line_stream, is_commented, iter_classified_lines
 from jdw_billboarding.lib.parsing import parse_synth_chunk
-from jdw_billboarding.lib.filtering import extract_commands, extract_default_args, extract_group_filters, extract_synth_chunks
-
-
-def parse_billboard(billboard_string: str) -> Billboard:
-    lines = classify_lines(billboard_string)
-    filters = extract_group_filters(lines)
-    billboard_default_args = extract_default_args(lines)
-    command_lines = extract_commands(lines)
+from jdw_billboarding.lib.filtering import extract_commands, extract_default_args, extract_group_filters, iter_synth_chunks
+
+
+# Everything process_synth_section output depends on: the raw chunk lines plus the billboard-wide context
+SectionKey = tuple[tuple[str, ...], str, str, str, int, int]
+
+def synth_chunk_key(chunk: list[BillboardLine], billboard_default_args: str, scale_data: ScaleData, transpose_steps: int) -> SectionKey:
+    return (
+        tuple(line.content for line in chunk),
+        billboard_default_args,
+        scale_data.scale_key,
+        scale_data.scale_type,
+        scale_data.ocatave_start,
+        transpose_steps
+    )
+
+# Top level so that it can be sent to a process pool
+def _process_synth_chunk(chunk: list[BillboardLine], billboard_default_args: str, scale_data: ScaleData, transpose_steps: int) -> BillboardSynthSection:
+    return process_synth_section(parse_synth_chunk(chunk), billboard_default_args, scale_data, transpose_steps)
+
+# Passing a section_cache reuses any section whose chunk and context are unchanged since the last parse.
+# The cache is pruned in-place to only hold the sections of this billboard.
+# Passing an executor (e.g. a ProcessPoolExecutor) processes the remaining sections in parallel; order is kept as-is.
+@timed("parse_billboard")
+def parse_billboard(billboard_string: str, section_cache: dict[SectionKey, BillboardSynthSection] | None = None, executor: "Executor | None" = None) -> Billboard:
+    return parse_billboard_lines(timed_iter("classify_lines", iter_classified_lines(billboard_string)), section_cache, executor)
+
+# As parse_billboard, but streaming the file instead of holding all of its content
+@timed("parse_billboard_file")
+def parse_billboard_file(billboard_file: BillboardFile, section_cache: dict[SectionKey, BillboardSynthSection] | None = None, executor: "Executor | None" = None) -> Billboard:
+    return parse_billboard_lines(timed_iter("classify_lines", classify_line_stream(billboard_file.lines())), section_cache, executor)
+
+"""
+    Builds the billboard in a single pass over classified lines.
+    Once tracks have started, every non-empty line classifies as a synth header, track, effect or group filter, so the
+    DEFAULT and command lines that sections depend on all come before the first synth header. Without an executor,
+    each synth chunk is processed as soon as it is complete and never more than one chunk of lines is held.
+"""
+def parse_billboard_lines(lines: Iterable[BillboardLine], section_cache: dict[SectionKey, BillboardSynthSection] | None = None, executor: "Executor | None" = None) -> Billboard:
+    line_iter = iter(lines)
+
+    header_lines: list[BillboardLine] = []
+    first_chunk_line: BillboardLine | None = None
+    for line in line_iter:
+        if line.type == BillboardLineType.SYNTH_HEADER and not is_commented(line.content):
+            first_chunk_line = line
+            break
+        header_lines.append(line)
+
+    billboard_default_args = extract_default_args(header_lines)
+    command_lines = extract_commands(header_lines)
     commands = [parse_command(line) for line in command_lines]
-
-    transpose_steps:int = 0
-    for command in commands:
-        if command.address == "/transpose":
-            transpose_steps = int(command.args[0])
-
-    synth_chunks = extract_synth_chunks(lines)
-
-    synth_sections = [parse_synth_chunk(chunk) for chunk in synth_chunks]
-
-    # Sane default
-    scale_data = ScaleData("c", "maj", 4)
-    for command in commands:
-        if command.address == "/set_scale":
-            scale_data = ScaleData(str(command.args[0]), str(command.args[1]), int(command.args[2]))
+    # Later commands override earlier ones of the same address
+    command_values = {command.address: command.value for command in commands if get_command_handler(command.address) != None}
+
+    transpose_steps: int = command_values.get("/transpose", 0)
+    scale_data: ScaleData = command_values.get("/set_scale", ScaleData("c", "maj", 4)) # Sane default
+
+    # Group filters may also appear between (or inside) synth sections
+    filter_lines: list[BillboardLine] = [line for line in header_lines if line.type == BillboardLineType.GROUP_FILTER]
+    def section_lines() -> Iterator[BillboardLine]:
+        if first_chunk_line != None:
+            yield first_chunk_line
+        for line in line_iter:
+            if line.type == BillboardLineType.GROUP_FILTER:
+                filter_lines.append(line)
+            yield line
 
     # TODO TRANSPOSE: This is where jdw data becomes messages (ElementMessage)
-    sections: list[BillboardSynthSection] = [process_synth_section(s, billboard_default_args, scale_data, transpose_steps) for s in synth_sections]
-
-    return Billboard(sections, filters, commands)
+    keys: list[SectionKey] = []
+    sections: list[BillboardSynthSection | None] = []
+    to_process: list[list[BillboardLine]] = []
+    # Lines are classified as chunks pull them, so that classify_lines time is also part of extract_synth_chunks
+    for chunk in timed_iter("extract_synth_chunks", iter_synth_chunks(section_lines())):
+        key = synth_chunk_key(chunk, billboard_default_args, scale_data, transpose_steps)
+        section = section_cache.get(key) if section_cache != None else None
+        if section == None:
+            if executor != None:
+                # Held until all chunks are known, so that they can be spread over the pool
+                to_process.append(chunk)
+            else:
+                section = _process_synth_chunk(chunk, billboard_default_args, scale_data, transpose_steps)
+        keys.append(key)
+        sections.append(section)
+
+    if len(to_process) > 0:
+        context_args = (repeat(billboard_default_args), repeat(scale_data), repeat(transpose_steps))
+        processed = iter(executor.map(_process_synth_chunk, to_process, *context_args) if executor != None and len(to_process) > 1 \
+            else map(_process_synth_chunk, to_process, *context_args))
+        sections = [section if section != None else next(processed) for section in sections]
+
+    finished: list[BillboardSynthSection] = [section for section in sections if section != None]
+
+    if section_cache != None:
+        section_cache.clear()
+        section_cache.update(zip(keys, finished))
+
+    filters = extract_group_filters(filter_lines)
+
+    return Billboard(finished, filters, commands, command_values)
 
 
 
@@ -0,0 +1,84 @@
+# Purpose: Reading .bbd files without loading them into one string first.
+#   The file is memory-mapped and decoded a chunk at a time, yielding the same lines as line_classify.iter_lines would
+#   for the full content, so that classification and section parsing can consume them lazily.
+
+import codecs
+import mmap
+import os
+from dataclasses import dataclass
+from typing import Iterator
+
+from jdw_billboarding.lib.line_classify import normalize_line
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+# Pass as bbd_content to the billboard_running calls to read the billboard from a file
+@dataclass(frozen=True)
+class BillboardFile:
+    path: str
+    chunk_size: int = DEFAULT_CHUNK_SIZE
+    encoding: str = "utf-8"
+    # Load from (and keep up to date) a compiled path + ".cache" file, see billboard_cache
+    use_cache: bool = False
+
+    def lines(self) -> Iterator[str]:
+        return iter_file_lines(self.path, self.chunk_size, self.encoding)
+
+    # Changes whenever the file is written to, used by sessions to skip re-parsing an untouched file
+    def signature(self) -> tuple[str, int, int]:
+        stat = os.stat(self.path)
+        return (os.path.abspath(self.path), stat.st_size, stat.st_mtime_ns)
+
+def _iter_file_chunks(path: str, chunk_size: int, encoding: str) -> Iterator[str]:
+    decoder = codecs.getincrementaldecoder(encoding)()
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        # Empty files can't be mapped
+        if size > 0:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for start in range(0, size, chunk_size):
+                    # Multi-byte characters split between chunks are held back by the decoder
+                    yield decoder.decode(mapped[start:start + chunk_size])
+    yield decoder.decode(b"", final=True)
+
+# Normalized, continuation-joined lines of a file; same output as iter_lines(file content)
+def iter_file_lines(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE, encoding: str = "utf-8") -> Iterator[str]:
+
+    carry = "" # Unterminated end of the previous chunk
+    continued: list[str] = [] # Physical lines joined by backslash continuation so far
+
+    for chunk in _iter_file_chunks(path, chunk_size, encoding):
+        pieces = (carry + chunk).split("\n")
+        carry = pieces.pop()
+        for piece in pieces:
+            if piece.endswith("\\"):
+                continued.append(piece[:-1])
+            else:
+                continued.append(piece)
+                yield normalize_line("".join(continued))
+                continued.clear()
+
+    continued.append(carry)
+    yield normalize_line("".join(continued))
+
+# Tests
+if __name__ == "__main__":
+
+    import random
+    import tempfile
+
+    from jdw_billboarding.lib.line_classify import iter_lines
+
+    rnd = random.Random(1)
+    atoms = ["#", " ", "\t", "\\", "\n", "\\\n", "    ", "€", "@synth", "a", "\r\n"]
+    for _ in range(500):
+        content = "".join(rnd.choice(atoms) for _ in range(rnd.randint(0, 40)))
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", newline="", suffix=".bbd", delete=False) as temp_file:
+            temp_file.write(content)
+        try:
+            # Tiny chunks to put continuations and multi-byte characters on chunk boundaries
+            for chunk_size in [1, 2, 3, 7, DEFAULT_CHUNK_SIZE]:
+                assert list(iter_file_lines(temp_file.name, chunk_size)) == list(iter_lines(content)), repr(content)
+            assert BillboardFile(temp_file.name).signature()[1] == len(content.encode("utf-8"))
+        finally:
+            os.remove(temp_file.name)
@@ -2,16 +2,21 @@
 
 from dataclasses import dataclass
 from decimal import Decimal
+from typing import TYPE_CHECKING, Iterator
 from pythonosc.osc_bundle import OscBundle
 from pythonosc.osc_message import OscMessage
-from pythonosc.osc_packet import OscPacket
-from shuttle_notation.parsing.information_parsing import ElementInformation
 
-from jdw_billboarding.lib.external_data_classes import SampleMessage, SynthDefMessage
+from jdw_billboarding.lib.external_data_classes import SampleIndex, SampleMessage, SynthDefMessage
 from jdw_billboarding.lib.nrt_scoring import Score
+from jdw_billboarding.lib.instrumentation import dgram_size, timed
 from jdw_billboarding.lib.billboard_classes import BillboardSynthSection, BillboardTrack, CommandContext, Billboard
+from jdw_billboarding.lib.billboard_commands import command_messages
 from jdw_billboarding.lib.jdw_osc_utils import ElementMessage, args_as_osc, create_batch_bundle, create_batch_queue_bundle, create_msg, create_nrt_record_bundle, create_queue_update_bundle, to_timed_osc
 
+# Executor is only used in annotations, and importing concurrent.futures pulls in logging
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
 def get_synth_keyboard_config(billboard: Billboard) -> list[OscMessage]:
 
     messages: list[OscMessage] = []
@@ -83,18 +88,7 @@ def get_all_command_messages(billboard: Billboard, type_filter: list[CommandCont
     for cmd in billboard.commands:
 
         if cmd.context in type_filter or len(type_filter) == 0:
-
-            if cmd.address == "/set_bpm":
-                ret.append(create_msg("/set_bpm", [int(cmd.args[0])]))
-            if cmd.address == "/keyboard_octave":
-                ret.append(create_msg("/keyboard_octave", [int(cmd.args[0])]))
-            if cmd.address == "/keyboard_quantization":
-                ret.append(create_msg("/keyboard_quantization", [cmd.args[0]]))
-            if cmd.address == "/create_router":
-                in_arg = float(cmd.args[0])
-                out_arg = float(cmd.args[1])
-                ext_id = "effect_router_" + str(in_arg) + "_" + str(out_arg)
-                ret.append(create_msg("/note_on", ["router", ext_id, 0, "in", in_arg, "out", out_arg]))
+            ret += command_messages(cmd)
 
     return ret
 
@@ -105,13 +99,10 @@ class NrtBundleInfo:
     preload_messages: list[OscMessage]
     preload_bundles: list[OscBundle]
 
-def _filter_used_samples(all_samples: list[SampleMessage], pack_name: str, track_messages: list[ElementMessage]) -> list[SampleMessage]:
-    pack_samples: list[SampleMessage] = [sample for sample in all_samples if sample.sample.sample_pack == pack_name]
-
-    used_samples: list[SampleMessage] = []
+def _filter_used_samples(sample_index: SampleIndex, pack_name: str, track_messages: list[ElementMessage]) -> list[SampleMessage]:
 
     # Replicating the category/index logic used in jdw-sc. Kinda clumsy, but works for a POC ...
-    usage_by_category: dict[str, list[int]] = {}
+    usage_by_category: dict[str, set[int]] = {}
 
     for msg in track_messages:
 
@@ -121,21 +112,9 @@ def _filter_used_samples(all_samples: list[SampleMessage], pack_name: str, track
         # NOTE: An easy way to avoid category resolution is to just count all categorized samples as used
         # .... ACTUALLY, I think category IS DETERMINED HERE, not in JDW_SC, so we can prob reuse that logic... duh.
         # SO, TODO: First check in the category resolution of default samples if this category is valid or should be ""
-        if msg.element.prefix not in usage_by_category:
-            usage_by_category[msg.element.prefix] = []
-
-        if msg.element.index not in usage_by_category[msg.element.prefix]:
-            usage_by_category[msg.element.prefix].append(msg.element.index)
-
-    for sample in pack_samples:
+        usage_by_category.setdefault(msg.element.prefix, set()).add(msg.element.index)
 
-        category = sample.sample.category if sample.sample.category in usage_by_category else ""
-        usage_in_category: list[int] = usage_by_category[category]
-
-        if sample.sample.tone_index in usage_in_category:
-            used_samples.append(sample)
-
-    return used_samples
+    return sample_index.find_used(pack_name, usage_by_category)
 
 """
 
@@ -151,7 +130,11 @@ def _filter_used_samples(all_samples: list[SampleMessage], pack_name: str, track
 
 
 """
-def get_nrt_record_bundles(billboard: Billboard, all_synthdefs: list[SynthDefMessage], all_samples: list[SampleMessage]) -> list[NrtBundleInfo]:
+# Pass a prebuilt SampleIndex as all_samples to avoid re-indexing a large sample library on every export
+# Pass the track_cache of a previous export to only re-encode the tracks whose notes or arrangement changed
+# compact_loops sends repeated tracks as loop bundles instead of unrolled notes (requires jdw-sc support)
+@timed("get_nrt_record_bundles")
+def get_nrt_record_bundles(billboard: Billboard, all_synthdefs: list[SynthDefMessage], all_samples: list[SampleMessage] | SampleIndex, track_cache: dict[str, tuple[bytes, list[OscBundle]]] | None = None, compact_loops: bool = False) -> list[NrtBundleInfo]:
 
     all_bundle_infos: list[NrtBundleInfo] = []
 
@@ -167,31 +150,43 @@ def get_nrt_record_bundles(billboard: Billboard, all_synthdefs: list[SynthDefMes
     for filter_set in billboard.group_filters:
         score.extend_groups(filter_set)
 
-    timed_track_messages: dict[str, list[OscBundle]] = score.unpack_timed_tracks()
+    timed_track_messages: dict[str, list[OscBundle]] = score.unpack_timed_tracks(track_cache, compact_loops)
 
     # TODO: Only interested in router commands, maybe a filter is easiest
     # Techincally we would like to use the bpm command as well for the final bpm of the nrt
     command_messages: list[OscMessage] = get_all_command_messages(billboard, [CommandContext.ALL, CommandContext.UPDATE])
     timed_cmd_msgs: list[OscBundle] = [to_timed_osc("0.0", msg) for msg in command_messages]
 
+    # Setup shared by all sections, built once and referenced by every track
+    timed_drone_msgs: list[OscBundle] = [to_timed_osc("0.0", msg) for msg in get_all_drones_create(billboard)]
+
+    bpm: float = float(billboard.command_values.get("/set_bpm", 120)) # TODO: See notes on current bpm type expectation issues
+
+    end_time: Decimal = score.get_end_time() + Decimal("8.0") # A little extra, but still doesn't account properly for release/delay/reverb
+
+    sample_index: SampleIndex = all_samples if isinstance(all_samples, SampleIndex) else SampleIndex.build(all_samples)
+
+    # Load messages by synth name, keeping the original synthdef order for when several are needed
+    synthdefs_by_name: dict[str, list[tuple[int, OscMessage]]] = {}
+    for i, synth in enumerate(all_synthdefs):
+        synthdefs_by_name.setdefault(synth.name, []).append((i, synth.load_msg))
+
     # Begin creating the bundles
     for section in billboard.sections:
 
         # TODO: Trying to understand why samplers sound strange in NRT
         timed_eff_msgs: list[OscBundle] = [to_timed_osc("0.0", msg) for msg in get_section_effects_create(section)]
-        timed_eff_msgs += [to_timed_osc("0.0", msg) for msg in get_all_drones_create(billboard)]
 
         # Preload messages are messages not part of the bundle but needed before the bundle is sent
         all_preload_messages: list[OscMessage] = [create_msg("/clear_nrt", [])]
-        all_setup_messages: list[OscBundle] = timed_cmd_msgs + timed_eff_msgs
+        all_setup_messages: list[OscBundle] = timed_cmd_msgs + timed_eff_msgs + timed_drone_msgs
 
         # TODO: Default synth name parsing is currently broken (names have different formats and the parse is half-finished)
-        needed_effect_names: list[str] = [e.synth_name for e in section.effects] + ["sampler", "router"]
-        needed_effect_names += [e.synth_name for e in section.drones]
-        def synth_needed(synth_name: str) -> bool:
-            #return True
-            return section.header.instrument_name == synth_name or synth_name in needed_effect_names
-        synth_create_msgs: list[OscMessage] = [synth.load_msg for synth in all_synthdefs if synth_needed(synth.name)]
+        needed_synth_names: set[str] = set([e.synth_name for e in section.effects] + ["sampler", "router"])
+        needed_synth_names.update([e.synth_name for e in section.drones])
+        needed_synth_names.add(section.header.instrument_name)
+        needed_synthdefs = [synthdef for name in needed_synth_names for synthdef in synthdefs_by_name.get(name, [])]
+        synth_create_msgs: list[OscMessage] = [load_msg for _, load_msg in sorted(needed_synthdefs, key=lambda synthdef: synthdef[0])]
 
         all_preload_messages += synth_create_msgs
 
@@ -201,7 +196,7 @@ def get_nrt_record_bundles(billboard: Billboard, all_synthdefs: list[SynthDefMes
             # Prepare sample loads, if relevant
             if section.header.is_sampler:
                 # TODO: Bring filtering back
-                my_samples = _filter_used_samples(all_samples, section.header.instrument_name, section.tracks[track_name].messages)
+                my_samples = _filter_used_samples(sample_index, section.header.instrument_name, section.tracks[track_name].messages)
                 #my_samples = all_samples
                 all_preload_messages += [s.load_msg for s in my_samples]
 
@@ -212,16 +207,7 @@ def get_nrt_record_bundles(billboard: Billboard, all_synthdefs: list[SynthDefMes
 
             # TODO: Assert that track is not empty or all silent
 
-            # NOTE: Bit of a hack; ideally we should use the already-parsed SET_BPM message from command_messages
-            bpm: float = 120.0 # TODO: See notes on current bpm type expectation issues
-            for cmd in billboard.commands:
-
-                if cmd.address == "/set_bpm":
-                    bpm = float(int(cmd.args[0]))
-
-
             file_name: str = "/home/estrandv/jdw_output/track_" + str(track_name) + ".wav"
-            end_time: Decimal = score.get_end_time() + Decimal("8.0") # A little extra, but still doesn't account properly for release/delay/reverb
 
             # No score bundles are included in this since it creates too massive bundles, instead we put them in preload
             bundle = create_nrt_record_bundle([], file_name, float(end_time), bpm)
@@ -231,15 +217,32 @@ def get_nrt_record_bundles(billboard: Billboard, all_synthdefs: list[SynthDefMes
     return all_bundle_infos
 
 
-def get_sequencer_batch_queue_bundle(billboard: Billboard) -> OscBundle:
-    queue_bundles: list[OscBundle] = []
+# Top level so that it can be sent to a process pool
+@timed("build_queue_bundle", size=dgram_size)
+def _build_queue_bundle(track_name: str, track: BillboardTrack) -> OscBundle:
+    timed_sequence = [to_timed_osc(msg.get_time(), msg.osc) for msg in track.messages]
+    return create_queue_update_bundle(track_name, timed_sequence)
+
+# Yields (track name, queue update bundle) for each track in the last defined group filter, one track at a time
+# Passing an executor builds the bundles in parallel instead, still yielding them in track order
+def iter_sequencer_queue_bundles(billboard: Billboard, executor: "Executor | None" = None) -> Iterator[tuple[str, OscBundle]]:
+    queued: list[tuple[str, BillboardTrack]] = []
     for sec in billboard.sections:
         for track_name in sec.tracks:
             track = sec.tracks[track_name]
 
             # Use the last defined group filter for queue updates
             if track.group_name in billboard.get_final_filter() or len(billboard.get_final_filter()) == 0:
-                timed_sequence = [to_timed_osc(msg.get_time(), msg.osc) for msg in track.messages]
-                queue_bundle = create_queue_update_bundle(track_name, timed_sequence)
-                queue_bundles.append(queue_bundle)
+                queued.append((track_name, track))
+
+    track_names = [track_name for track_name, _ in queued]
+    tracks = [track for _, track in queued]
+    bundles = executor.map(_build_queue_bundle, track_names, tracks) if executor != None and len(queued) > 1 \
+        else map(_build_queue_bundle, track_names, tracks)
+
+    for track_name, bundle in zip(track_names, bundles):
+        yield track_name, bundle
+
+def get_sequencer_batch_queue_bundle(billboard: Billboard, executor: "Executor | None" = None) -> OscBundle:
+    queue_bundles: list[OscBundle] = [queue_bundle for _, queue_bundle in iter_sequencer_queue_bundles(billboard, executor)]
     return create_batch_queue_bundle(queue_bundles, True)
@@ -1,25 +1,53 @@
 # Purpose: Highest-level billboarding calls for the main usage scenarios (setup/configure/run/nrt).
 
+import hashlib
 from dataclasses import dataclass
+from typing import TYPE_CHECKING, Iterator
 from pythonosc.osc_bundle import OscBundle
 from pythonosc.osc_message import OscMessage
 
-from jdw_billboarding.lib.billboard_osc_conversion import NrtBundleInfo, get_all_command_messages, get_all_drones_silence, get_all_effects_create, get_all_effects_mod, get_nrt_record_bundles, get_sampler_keyboard_config, get_sequencer_batch_queue_bundle, get_synth_keyboard_config, get_all_drones_create
-from jdw_billboarding.lib.billboard_construction import parse_billboard
+from jdw_billboarding.lib.billboard_osc_conversion import NrtBundleInfo, get_all_command_messages, get_all_drones_silence, get_all_effects_create, get_all_effects_mod, get_nrt_record_bundles, get_sampler_keyboard_config, get_sequencer_batch_queue_bundle, get_synth_keyboard_config, get_all_drones_create, iter_sequencer_queue_bundles
+from jdw_billboarding.lib.billboard_cache import load_billboard
+from jdw_billboarding.lib.billboard_construction import parse_billboard, parse_billboard_file
+from jdw_billboarding.lib.billboard_file import BillboardFile
+from jdw_billboarding.lib.billboard_session import BillboardSession
+from jdw_billboarding.lib.instrumentation import dgram_size, timed
 
 from jdw_billboarding.lib.billboard_classes import Billboard, CommandContext
-from jdw_billboarding.lib.external_data_classes import SampleMessage, SynthDefMessage
-from jdw_billboarding.lib.jdw_osc_utils import create_nrt_preload_bundle
+from jdw_billboarding.lib.external_data_classes import SampleIndex, SampleMessage, SynthDefMessage
+from jdw_billboarding.lib.jdw_osc_utils import NRT_PRELOAD_MAX_BYTES, create_batch_queue_bundle, create_nrt_preload_bundles
 
 from jdw_billboarding.lib.jdw_osc_utils import create_msg
 
+# Executor is only used in annotations, and importing concurrent.futures pulls in logging
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
 # TODO: No hard link for the common prefix yet
 def get_effects_clear() -> OscMessage:
     common_prefix = "effect_"
     return create_msg("/free_notes", ["^" + common_prefix + "(.*)"])
 
-def get_configuration_messages(bbd_content: str) -> list[OscMessage]:
-    billboard: Billboard = parse_billboard(bbd_content)
+# Pass the same session between calls to only re-parse the synth sections that changed since the last call
+# Pass a BillboardFile instead of the content to stream a (large) billboard from disk, use_cache=True to skip parsing
+#   it altogether while the file is unchanged
+def _parse(bbd_content: str | BillboardFile, session: BillboardSession | None) -> Billboard:
+    if session != None:
+        return session.parse(bbd_content)
+    if isinstance(bbd_content, BillboardFile):
+        return load_billboard(bbd_content) if bbd_content.use_cache else parse_billboard_file(bbd_content)
+    return parse_billboard(bbd_content)
+
+def _executor(session: BillboardSession | None) -> "Executor | None":
+    return session.executor if session != None else None
+
+# Compared between updates to tell which queues changed, cheaper to keep around than the full bundle
+def _queue_digest(queue_bundle: OscBundle) -> bytes:
+    return hashlib.blake2b(queue_bundle.dgram, digest_size=16).digest()
+
+@timed("get_configuration_messages", size=dgram_size)
+def get_configuration_messages(bbd_content: str | BillboardFile, session: BillboardSession | None = None) -> list[OscMessage]:
+    billboard: Billboard = _parse(bbd_content, session)
 
     all_messages: list[OscMessage] = []
 
@@ -33,8 +61,9 @@ def get_configuration_messages(bbd_content: str) -> list[OscMessage]:
 
     return all_messages
 
-def get_silence_drones(bbd_content: str) -> list[OscMessage]:
-    billboard: Billboard = parse_billboard(bbd_content)
+@timed("get_silence_drones", size=dgram_size)
+def get_silence_drones(bbd_content: str | BillboardFile, session: BillboardSession | None = None) -> list[OscMessage]:
+    billboard: Billboard = _parse(bbd_content, session)
 
     return get_all_drones_silence(billboard)
 
@@ -44,32 +73,138 @@ class NrtData:
     preload_messages: list[OscMessage]
     preload_bundle_batches: list[OscBundle]
 
+    # Everything to send for one track, in order: preload messages, preload batches and finally the record bundle
+    def packets(self) -> list[OscMessage | OscBundle]:
+        return self.preload_messages + self.preload_bundle_batches + [self.main_bundle]
+
 # TODO: synthdefs and samples are vagrant, but it's hard to package neatly without...
-def get_nrt_data(bbd_content: str, all_synthdefs: list[SynthDefMessage], all_samples: list[SampleMessage]) -> list[NrtData]:
-    billboard: Billboard = parse_billboard(bbd_content)
-    nrt_info: list[NrtBundleInfo] = get_nrt_record_bundles(billboard, all_synthdefs, all_samples)
+# Preload bundles are packed into batches of at most max_preload_size bytes each
+# compact_loops: see get_nrt_record_bundles
+@timed("get_nrt_data")
+def get_nrt_data(bbd_content: str | BillboardFile, all_synthdefs: list[SynthDefMessage], all_samples: list[SampleMessage] | SampleIndex, session: BillboardSession | None = None, max_preload_size: int = NRT_PRELOAD_MAX_BYTES, compact_loops: bool = False) -> list[NrtData]:
+    billboard: Billboard = _parse(bbd_content, session)
+    nrt_info: list[NrtBundleInfo] = get_nrt_record_bundles(billboard, all_synthdefs, all_samples, session.nrt_tracks if session != None else None, compact_loops)
     export: list[NrtData] = []
     for info in nrt_info:
-        # Just some batching hack I stole off stackoverflow
-        batch_size = 10
-        preload_batches: list[list[OscBundle]] = [info.preload_bundles[i * batch_size:(i + 1) * batch_size] for i in range((len(info.preload_bundles) + batch_size - 1) // batch_size )]
-        export.append(NrtData(info.nrt_bundle, info.preload_messages, [create_nrt_preload_bundle(batch) for batch in preload_batches]))
+        export.append(NrtData(info.nrt_bundle, info.preload_messages, create_nrt_preload_bundles(info.preload_bundles, max_preload_size)))
 
     return export
 
-def get_queue_update_packets(bbd_content: str) -> list[OscBundle | OscMessage]:
-
-    # TODO TRANSPOSE: This returns all commands, allowing you to peek inside and note the transpose
-    # It also contains all track note elements, so any transposition needs to happen inside of it
-    billboard: Billboard = parse_billboard(bbd_content)
+# Everything sent ahead of the track queues on a queue update
+def _get_queue_update_setup(billboard: Billboard) -> list[OscMessage]:
 
-    all_messages: list[OscMessage | OscBundle] = []
+    all_messages: list[OscMessage] = []
 
     # Keyboard is configured on regular run as well
     all_messages += get_synth_keyboard_config(billboard)
     all_messages += get_sampler_keyboard_config(billboard)
     all_messages += get_all_command_messages(billboard, [CommandContext.ALL, CommandContext.QUEUE])
     all_messages += get_all_effects_mod(billboard)
-    all_messages += [get_sequencer_batch_queue_bundle(billboard)]
 
     return all_messages
+
+@timed("get_queue_update_packets", size=dgram_size)
+def get_queue_update_packets(bbd_content: str | BillboardFile, session: BillboardSession | None = None) -> list[OscBundle | OscMessage]:
+
+    # TODO TRANSPOSE: This returns all commands, allowing you to peek inside and note the transpose
+    # It also contains all track note elements, so any transposition needs to happen inside of it
+    billboard: Billboard = _parse(bbd_content, session)
+
+    all_messages: list[OscMessage | OscBundle] = []
+    all_messages += _get_queue_update_setup(billboard)
+
+    queue_bundles: list[tuple[str, OscBundle]] = list(iter_sequencer_queue_bundles(billboard, _executor(session)))
+    all_messages += [create_batch_queue_bundle([queue_bundle for _, queue_bundle in queue_bundles], True)]
+
+    # Batch updates stop every queue not included, so this is now the full set of queued tracks
+    if session != None:
+        session.queued_tracks = {track_name: _queue_digest(queue_bundle) for track_name, queue_bundle in queue_bundles}
+
+    return all_messages
+
+# Streaming alternative to get_queue_update_packets: setup messages first, then one update_queue bundle per track
+# as soon as it has been built, so that sending can start before the whole billboard is converted.
+# Since there is no single batch bundle, stop_missing only applies to queues that the session sent last time but that
+# are no longer part of the billboard: if there are any, the queues just sent are repeated in a closing stop_missing
+# batch so that jdw-sc stops the rest. A session that hasn't sent an update yet always closes with that batch, as it
+# can't know what is already playing (without a session, nothing is stopped).
+def iter_queue_update_packets(bbd_content: str | BillboardFile, session: BillboardSession | None = None, stop_missing: bool = True) -> Iterator[OscBundle | OscMessage]:
+    billboard: Billboard = _parse(bbd_content, session)
+
+    for msg in _get_queue_update_setup(billboard):
+        yield msg
+
+    sent_tracks: dict[str, bytes] = {}
+    sent_bundles: list[OscBundle] = []
+    for track_name, queue_bundle in iter_sequencer_queue_bundles(billboard, _executor(session)):
+        sent_tracks[track_name] = _queue_digest(queue_bundle)
+        sent_bundles.append(queue_bundle)
+        yield queue_bundle
+
+    if session != None:
+        if stop_missing:
+            if session.queued_tracks == None or len(session.queued_tracks.keys() - sent_tracks.keys()) > 0:
+                yield create_batch_queue_bundle(sent_bundles, True)
+            session.queued_tracks = sent_tracks
+        elif session.queued_tracks != None:
+            session.queued_tracks.update(sent_tracks)
+
+# Like get_queue_update_packets, but only resends the queues that changed since the last update sent from the session.
+# Changed queues go out as one batch that leaves every other queue playing untouched. If a queue was removed from the
+# billboard, or the session hasn't sent an update yet (so queues left by e.g. an earlier process are unknown), the
+# batch instead holds every current queue and stops the missing ones, as get_queue_update_packets does.
+# The batch is left out entirely when no queue changed.
+@timed("get_queue_diff_packets", size=dgram_size)
+def get_queue_diff_packets(bbd_content: str | BillboardFile, session: BillboardSession) -> list[OscBundle | OscMessage]:
+    billboard: Billboard = _parse(bbd_content, session)
+
+    all_messages: list[OscMessage | OscBundle] = []
+    all_messages += _get_queue_update_setup(billboard)
+
+    previous = session.queued_tracks
+    changed: list[OscBundle] = []
+    current: list[OscBundle] = []
+    sent_tracks: dict[str, bytes] = {}
+    for track_name, queue_bundle in iter_sequencer_queue_bundles(billboard, _executor(session)):
+        sent_tracks[track_name] = _queue_digest(queue_bundle)
+        current.append(queue_bundle)
+        if previous == None or previous.get(track_name) != sent_tracks[track_name]:
+            changed.append(queue_bundle)
+
+    if previous == None or len(previous.keys() - sent_tracks.keys()) > 0:
+        all_messages += [create_batch_queue_bundle(current, True)]
+    elif len(changed) > 0:
+        all_messages += [create_batch_queue_bundle(changed, False)]
+
+    session.queued_tracks = sent_tracks
+
+    return all_messages
+
+# Live-coding clients and editor plugins import this module on every short-lived invocation
+# Typically measured at well under 100ms; the budget is there to catch heavy dependencies (e.g. pretty_midi, which
+#   pulls in numpy and mido for hundreds of ms) creeping back into the import path, not to flake on a busy machine
+IMPORT_TIME_BUDGET_MS = 150
+IMPORT_TIME_RUNS = 5
+
+# Tests
+if __name__ == "__main__":
+
+    import subprocess
+    import sys
+    from statistics import median
+
+    # Measured in fresh interpreters, so that nothing is already cached in sys.modules
+    def measure_import() -> tuple[float, bool]:
+        output = subprocess.check_output([sys.executable, "-c",
+            "import sys, time; start = time.perf_counter(); import jdw_billboarding.lib.billboard_running; " +
+            "print((time.perf_counter() - start) * 1000, 'pretty_midi' in sys.modules)"
+        ]).decode().split()
+        return float(output[0]), output[1] == "True"
+
+    # The first run also writes bytecode caches, so it is not counted
+    measure_import()
+    samples = [measure_import() for _ in range(IMPORT_TIME_RUNS)]
+    import_time_ms = median(time_ms for time_ms, _ in samples)
+
+    assert not any(has_pretty_midi for _, has_pretty_midi in samples), "pretty_midi should not be imported by billboard_running"
+    assert import_time_ms < IMPORT_TIME_BUDGET_MS, "Import took " + str(import_time_ms) + "ms (median of " + str(IMPORT_TIME_RUNS) + "), budget is " + str(IMPORT_TIME_BUDGET_MS) + "ms"
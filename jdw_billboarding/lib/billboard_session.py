@@ -0,0 +1,55 @@
+# Purpose: Keeping parse results alive between billboard_running calls, so that repeated updates of the same
+#   billboard only re-parse what was actually edited.
+
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+from pythonosc.osc_bundle import OscBundle
+
+from jdw_billboarding.lib.billboard_classes import Billboard, BillboardSynthSection
+from jdw_billboarding.lib.billboard_cache import load_billboard
+from jdw_billboarding.lib.billboard_construction import SectionKey, parse_billboard, parse_billboard_file
+from jdw_billboarding.lib.billboard_file import BillboardFile
+
+# Executor is only used in annotations, and importing concurrent.futures pulls in logging
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+@dataclass
+class BillboardSession:
+    # Sections of the last parse, by chunk content and the DEFAULT/scale/transpose context they were resolved with
+    sections: dict[SectionKey, BillboardSynthSection] = field(default_factory=dict)
+    # Content of the last parse, or the signature of the last parsed BillboardFile
+    last_content: str | tuple[str, int, int] | None = None
+    last_billboard: Billboard | None = None
+    # Sequencer queues last sent from this session, by name, with a digest of the update_queue bundle sent.
+    # None until an update has stopped the queues not sent, as queues left playing by e.g. an earlier process are unknown
+    queued_tracks: dict[str, bytes] | None = None
+    # Encoded NRT timeline bundles of the last export, by track name, with the digest they were built for
+    nrt_tracks: dict[str, tuple[bytes, list[OscBundle]]] = field(default_factory=dict)
+    # Optional pool (owned by the caller) for processing changed sections and building queue bundles in parallel
+    executor: "Executor | None" = None
+
+    def parse(self, bbd_content: str | BillboardFile) -> Billboard:
+
+        content_key = bbd_content.signature() if isinstance(bbd_content, BillboardFile) else bbd_content
+
+        # Nothing edited at all, e.g. hitting "queue update" twice
+        if self.last_billboard != None and content_key == self.last_content:
+            return self.last_billboard
+
+        if isinstance(bbd_content, BillboardFile) and bbd_content.use_cache:
+            billboard = load_billboard(bbd_content, self.sections, self.executor)
+        elif isinstance(bbd_content, BillboardFile):
+            billboard = parse_billboard_file(bbd_content, self.sections, self.executor)
+        else:
+            billboard = parse_billboard(bbd_content, self.sections, self.executor)
+        self.last_content = content_key
+        self.last_billboard = billboard
+        return billboard
+
+    def clear(self):
+        self.sections.clear()
+        self.last_content = None
+        self.last_billboard = None
+        self.queued_tracks = None
+        self.nrt_tracks.clear()
@@ -31,16 +31,18 @@ TODO:
 # TODO: Pass in, somehow...
 SC_DELAY_MS = 70
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
+from typing import Sequence
 from pythonosc.osc_message import OscMessage
 from shuttle_notation.parsing.element import ResolvedElement
-from pretty_midi import note_number_to_hz
 
 from jdw_billboarding.lib.billboard_classes import ElementMessage
-from jdw_billboarding.lib.jdw_osc_utils import args_as_osc, create_msg
+from jdw_billboarding.lib.jdw_osc_utils import ArgPacker, create_msg
+from jdw_billboarding.lib.osc_encoding import EncodedMessage, encode_note_modify, encode_note_on_timed, encode_play_sample
 from jdw_billboarding.lib.line_classify import begins_with
 from jdw_billboarding.lib.parsing import cut_first
+from jdw_billboarding.lib.instrumentation import count_notes, timed
 import jdw_billboarding.lib.note_utils as note_utils
 
 def is_symbol(element: ResolvedElement, sym: str) -> bool:
@@ -59,6 +61,20 @@ class ScaleData:
     scale_type: str
     ocatave_start: int
 
+# Pitch of each element in a track, classified once so that frequencies for a transposition are one table pass
+@dataclass(slots=True)
+class TrackPitches:
+    # Midi note number before transposition (0 where the element has an explicit freq arg)
+    notes: list[int] = field(default_factory=list)
+    # Explicit freq args, by element position
+    explicit_freqs: dict[int, float] = field(default_factory=dict)
+
+    def freqs(self, transpose_steps: int = 0) -> list[float]:
+        freqs = note_utils.midis_to_hz(self.notes, transpose_steps)
+        for i, freq in self.explicit_freqs.items():
+            freqs[i] = freq
+        return freqs
+
 @dataclass
 class ElementConverter:
     instrument_name: str
@@ -67,12 +83,36 @@ class ElementConverter:
     external_id_override: str
     scale_data: ScaleData
     id_counter: int = 0 # So as to give different ids to each sequential note in a track
+    # Every message of the track is packed with the same "freq" override
+    arg_packer: ArgPacker = field(default_factory=lambda: ArgPacker(("freq",)))
+
+    """
+        Messages for a whole track, skipping ignored elements. Frequencies are resolved in one pass over the track
+        (see track_pitches) instead of per element.
+    """
+    @timed("resolve_messages", notes=count_notes)
+    def resolve_messages(self, elements: Sequence[ResolvedElement], transpose_steps: int = 0) -> list[ElementMessage]:
+        freqs = self.track_pitches(elements).freqs(transpose_steps if self.instrument_type != InstrumentType.SAMPLER else 0)
+
+        resolved: list[ElementMessage] = []
+        for element, freq in zip(elements, freqs):
+            msg = self.resolve_message(element, transpose_steps, freq)
+            if msg != None:
+                resolved.append(msg)
+        return resolved
 
     # TODO: Not sure if transpose steps is relevant here, should it be class level?
-    def resolve_message(self, element: ResolvedElement, transpose_steps: int = 0) -> ElementMessage | None:
+    # freq: the element's frequency if already known; transposed, except in sampler tracks where it is the untransposed
+    #   frequency that samples are played with (the rare note mod or drone in a sampler track then resolves its own)
+    def resolve_message(self, element: ResolvedElement, transpose_steps: int = 0, freq: float | None = None) -> ElementMessage | None:
+        in_sampler = self.instrument_type == InstrumentType.SAMPLER
+        plain_sample = in_sampler and not begins_with(element.suffix, "@") and not begins_with(element.suffix, "$")
+        if freq == None or (in_sampler and not plain_sample and transpose_steps != 0):
+            freq = self.resolve_freq(element, 0 if plain_sample else transpose_steps)
+
         if begins_with(element.suffix, "@"):
             # Remove symbol from suffix to create note mod external id
-            return ElementMessage(element, self.to_note_mod(element, cut_first(element.suffix, 1), transpose_steps))
+            return ElementMessage(element, self.to_note_mod(element, freq, cut_first(element.suffix, 1)))
         elif is_symbol(element, "x"):
             # Silence
             return ElementMessage(element, create_msg("/empty_msg", []))
@@ -84,22 +124,21 @@ class ElementConverter:
             return ElementMessage(element, create_msg("/jdw_sc_event_trigger", ["loop_started", SC_DELAY_MS]))
         elif begins_with(element.suffix, "$"):
             # Drone, note that suffix is trimmed similar to for note mod
-            return ElementMessage(element, self.to_note_on(element, cut_first(element.suffix, 1), transpose_steps))
+            return ElementMessage(element, self.to_note_on(element, freq, cut_first(element.suffix, 1)))
         elif self.instrument_type == InstrumentType.DRONE:
-            return ElementMessage(element, self.to_note_mod(element, transpose_steps))
+            return ElementMessage(element, self.to_note_mod(element, freq))
         elif self.instrument_type == InstrumentType.SAMPLER:
-            return ElementMessage(element, self.to_play_sample(element))
+            return ElementMessage(element, self.to_play_sample(element, freq))
         else:
-            return ElementMessage(element, self.to_note_on_timed(element, transpose_steps))
+            return ElementMessage(element, self.to_note_on_timed(element, freq))
 
-    def to_note_mod(self, element: ResolvedElement, transpose_steps: int = 0) -> OscMessage:
-        external_id = self.resolve_external_id(element) if self.external_id_override == "" else self.external_id_override
-        osc_args = args_as_osc(element.args, ["freq", self.resolve_freq(element, transpose_steps)])
-        return create_msg("/note_modify", [external_id, SC_DELAY_MS] + osc_args)
-
-    def to_note_on_timed(self, element: ResolvedElement, transpose_steps: int = 0) -> OscMessage:
-        freq = self.resolve_freq(element, transpose_steps)
+    def to_note_mod(self, element: ResolvedElement, freq: float, external_id_override: str = "") -> OscMessage:
+        external_id = external_id_override if external_id_override != "" else \
+            self.resolve_external_id(element) if self.external_id_override == "" else self.external_id_override
+        osc_args = self.arg_packer.pack(element.args, [freq])
+        return EncodedMessage(encode_note_modify(external_id, SC_DELAY_MS, osc_args))
 
+    def to_note_on_timed(self, element: ResolvedElement, freq: float) -> OscMessage:
         external_id = self.resolve_external_id(element)
 
         sus: float = element.args["sus"] if "sus" in element.args else 0.0
@@ -107,19 +146,19 @@ class ElementConverter:
             print("WARN: Element converted to timed note press did not contain a sus arg (will be 0.0): ", element)
 
         gate_time = str(sus)
-        osc_args = args_as_osc(element.args, ["freq", freq])
-        return create_msg("/note_on_timed", [self.instrument_name, external_id, gate_time, SC_DELAY_MS] + osc_args)
+        osc_args = self.arg_packer.pack(element.args, [freq])
+        return EncodedMessage(encode_note_on_timed(self.instrument_name, external_id, gate_time, SC_DELAY_MS, osc_args))
 
-    def to_play_sample(self, element: ResolvedElement) -> OscMessage:
-        osc_args = args_as_osc(element.args, ["freq", self.resolve_freq(element)])
-        return create_msg("/play_sample", [
-            self.resolve_external_id(element), self.instrument_name, element.index, element.prefix, SC_DELAY_MS
-        ] + osc_args)
+    # Samples are picked by index, but jdw-sc still gets the (untransposed) freq of the element
+    def to_play_sample(self, element: ResolvedElement, freq: float | None = None) -> OscMessage:
+        osc_args = self.arg_packer.pack(element.args, [freq if freq != None else self.resolve_freq(element)])
+        return EncodedMessage(encode_play_sample(
+            self.resolve_external_id(element), self.instrument_name, element.index, element.prefix, SC_DELAY_MS, osc_args
+        ))
 
-    def to_note_on(self, element: ResolvedElement, external_id_override: str = "", transpose_steps: int = 0) -> OscMessage:
+    def to_note_on(self, element: ResolvedElement, freq: float, external_id_override: str = "") -> OscMessage:
         external_id = self.resolve_external_id(element) if external_id_override == "" else external_id_override
-        freq = self.resolve_freq(element, transpose_steps)
-        osc_args = args_as_osc(element.args, ["freq", freq])
+        osc_args = self.arg_packer.pack(element.args, [freq])
         return create_msg("/note_on", [self.instrument_name, external_id, SC_DELAY_MS] + osc_args)
 
     def resolve_external_id(self, element: ResolvedElement) -> str:
@@ -136,19 +175,20 @@ class ElementConverter:
         if "freq" in element.args:
             return float(element.args["freq"])
 
+        return note_utils.midi_to_hz(self.resolve_note(element) + transpose_steps)
+
+    # Untransposed midi note number of an element, from its note letter or its index in the scale
+    def resolve_note(self, element: ResolvedElement) -> int:
+
         letter_check = note_utils.note_letter_to_midi(element.prefix)
 
         if letter_check == -1:
 
-
             index = note_utils.resolve_index(element.index, self.scale_data.scale_key, self.scale_data.scale_type)
 
             octave = self.scale_data.ocatave_start
             extra = (12 * (octave + 1)) if octave > 0 else 0
-            new_index = index + extra + transpose_steps
-
-            freq = note_number_to_hz(new_index)
-            return freq
+            return index + extra
 
         else:
             # As in the "3" of "c3"
@@ -156,6 +196,33 @@ class ElementConverter:
 
             # Math, same as for index freq calculation
             extra = (12 * (octave - 1)) if octave > 0 else 0
-            new_index = letter_check + extra + transpose_steps
-
-            return note_number_to_hz(new_index)
+            return letter_check + extra
+
+    # Same classification as resolve_note, with the scale lookups hoisted out of the per-element loop
+    def track_pitches(self, elements: Sequence[ResolvedElement]) -> TrackPitches:
+        letter_notes = note_utils.MIDI_MAP
+        resolve_index = note_utils.resolve_index
+        scale_key = self.scale_data.scale_key
+        scale_type = self.scale_data.scale_type
+        scale_octave = self.scale_data.ocatave_start
+        scale_extra = (12 * (scale_octave + 1)) if scale_octave > 0 else 0
+
+        pitches = TrackPitches()
+        notes = pitches.notes
+        index_notes: dict[int, int] = {} # Tracks mostly repeat a handful of scale indices
+        for i, element in enumerate(elements):
+            if "freq" in element.args:
+                pitches.explicit_freqs[i] = float(element.args["freq"])
+                notes.append(0)
+                continue
+            letter = letter_notes.get(element.prefix)
+            if letter == None:
+                note = index_notes.get(element.index)
+                if note == None:
+                    note = resolve_index(element.index, scale_key, scale_type) + scale_extra
+                    index_notes[element.index] = note
+                notes.append(note)
+            else:
+                octave = element.index
+                notes.append(letter + ((12 * (octave - 1)) if octave > 0 else 0))
+        return pitches
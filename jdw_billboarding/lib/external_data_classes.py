@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pythonosc.osc_message import OscMessage
 
 @dataclass
@@ -23,3 +23,29 @@ class Sample:
 class SampleMessage:
     sample: Sample
     load_msg: OscMessage
+
+# Samples by pack -> category -> tone_index, along with their position in the original sample list
+@dataclass
+class SampleIndex:
+    packs: dict[str, dict[str, dict[int, list[tuple[int, SampleMessage]]]]] = field(default_factory=dict)
+
+    @staticmethod
+    def build(all_samples: list[SampleMessage]) -> "SampleIndex":
+        index = SampleIndex()
+        for position, sample in enumerate(all_samples):
+            categories = index.packs.setdefault(sample.sample.sample_pack, {})
+            tones = categories.setdefault(sample.sample.category, {})
+            tones.setdefault(sample.sample.tone_index, []).append((position, sample))
+        return index
+
+    # Samples in the pack matching the used tone indices, in original sample list order
+    # Categories without usage of their own fall back to the usage of the blank category
+    def find_used(self, pack_name: str, usage_by_category: dict[str, set[int]]) -> list[SampleMessage]:
+        found: list[tuple[int, SampleMessage]] = []
+
+        for category, tones in self.packs.get(pack_name, {}).items():
+            usage = usage_by_category[category] if category in usage_by_category else usage_by_category.get("", set())
+            for tone_index in usage:
+                found += tones.get(tone_index, [])
+
+        return [sample for _, sample in sorted(found, key=lambda entry: entry[0])]
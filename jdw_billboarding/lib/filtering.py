@@ -1,4 +1,7 @@
+from typing import Iterable, Iterator
+
 from jdw_billboarding.lib.line_classify import BillboardLine, BillboardLineType, is_commented
+from jdw_billboarding.lib.instrumentation import timed
 
 def extract_commands(lines: list[BillboardLine]) -> list[str]:
     return [line.content for line in lines if not is_commented(line.content) and line.type == BillboardLineType.COMMAND]
@@ -24,17 +27,25 @@ def extract_group_filters(lines: list[BillboardLine]) -> list[list[str]]:
     return full_set
 
 # Returns billboard lines sorted by synth headers (each sublist containinng the header and the lines below it)
+@timed("extract_synth_chunks")
 def extract_synth_chunks(lines: list[BillboardLine]) -> list[list[BillboardLine]]:
-    separated: list[list[BillboardLine]] = []
+    return list(iter_synth_chunks(lines))
+
+# Lazy version of the above, yielding each chunk as soon as the next synth header (or the end) is reached
+def iter_synth_chunks(lines: Iterable[BillboardLine]) -> Iterator[list[BillboardLine]]:
+    current: list[BillboardLine] | None = None
 
     for line in lines:
         if line.type == BillboardLineType.SYNTH_HEADER:
             if not is_commented(line.content):
-                separated.append([line])
-        elif len(separated) > 0:
-            separated[-1].append(line)
+                if current != None:
+                    yield current
+                current = [line]
+        elif current != None:
+            current.append(line)
 
-    return separated
+    if current != None:
+        yield current
 
 # Tests
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+# Purpose: Opt-in timing of the parse -> OSC hot path, to see whether a lagging update is spent parsing, converting
+#   or encoding.
+#
+#   with instrumented() as stats:
+#       get_queue_update_packets(content)
+#   print(stats.format_report())
+#
+# Stage times are inclusive wall time (e.g. parse_track time is also part of process_synth_section).
+# Stages are whole tracks and sections rather than single notes, whose timer would cost a good part of the work
+#   measured; per-note throughput comes from the notes counter of stages such as parse_track and resolve_messages.
+# Only the calling thread/task is measured: work handed to an executor is timed as a whole by the stage that
+# submitted it, not per stage inside the workers.
+
+import functools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, Iterator, TypeVar
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    seconds: float = 0.0
+    notes: int = 0
+    bytes: int = 0
+
+@dataclass
+class Instrumentation:
+    stages: dict[str, StageStats] = field(default_factory=dict)
+
+    def record(self, stage_name: str, seconds: float, notes: int = 0, byte_count: int = 0):
+        stats = self.stages.get(stage_name)
+        if stats == None:
+            stats = StageStats()
+            self.stages[stage_name] = stats
+        stats.calls += 1
+        stats.seconds += seconds
+        stats.notes += notes
+        stats.bytes += byte_count
+
+    # Structured report, slowest stage first
+    def report(self) -> list[dict[str, Any]]:
+        return [
+            {"stage": name, "calls": stats.calls, "total_ms": stats.seconds * 1000,
+             "mean_us": stats.seconds * 1000000 / stats.calls if stats.calls > 0 else 0.0,
+             "notes": stats.notes, "bytes": stats.bytes}
+            for name, stats in sorted(self.stages.items(), key=lambda item: -item[1].seconds)
+        ]
+
+    def format_report(self) -> str:
+        lines = ["stage".ljust(32) + "calls".rjust(8) + "total ms".rjust(12) + "mean us".rjust(12) + "notes".rjust(10) + "bytes".rjust(12)]
+        for row in self.report():
+            lines.append(row["stage"].ljust(32) + str(row["calls"]).rjust(8) + ("%.3f" % row["total_ms"]).rjust(12)
+                + ("%.1f" % row["mean_us"]).rjust(12) + str(row["notes"]).rjust(10) + str(row["bytes"]).rjust(12))
+        return "\n".join(lines)
+
+_current: ContextVar[Instrumentation | None] = ContextVar("jdw_billboarding_instrumentation", default=None)
+
+def active() -> Instrumentation | None:
+    return _current.get()
+
+# Collects stage stats for everything called inside the block; nested blocks collect separately
+@contextmanager
+def instrumented(instrumentation: Instrumentation | None = None) -> Iterator[Instrumentation]:
+    collector = instrumentation if instrumentation != None else Instrumentation()
+    token = _current.set(collector)
+    try:
+        yield collector
+    finally:
+        _current.reset(token)
+
+# Times a block as a stage, for code that isn't a single function call
+@contextmanager
+def stage(stage_name: str) -> Iterator[None]:
+    collector = _current.get()
+    if collector == None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        collector.record(stage_name, time.perf_counter() - start)
+
+"""
+    Decorator marking a function as a stage. When nothing is being instrumented this costs one context variable
+    lookup per call. The optional counters take the function's return value:
+        notes: number of notes it handled
+        size: encoded size in bytes
+"""
+def timed(stage_name: str, notes: Callable[[Any], int] | None = None, size: Callable[[Any], int] | None = None):
+    def decorate(fn: Callable) -> Callable:
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            collector = _current.get()
+            if collector == None:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            result = fn(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+            collector.record(stage_name, elapsed, notes(result) if notes != None else 0, size(result) if size != None else 0)
+            return result
+
+        return wrapper
+    return decorate
+
+T = TypeVar("T")
+
+"""
+    Times a lazily consumed iterator as a stage: only the time spent producing its items counts, not the consumer's
+    work in between. Recorded as one call once the iterator is exhausted or closed; without an active collector the
+    items are passed through untouched.
+"""
+def timed_iter(stage_name: str, items: Iterable[T]) -> Iterator[T]:
+    collector = _current.get()
+    if collector == None:
+        return iter(items)
+    return _timed_items(collector, stage_name, iter(items))
+
+def _timed_items(collector: Instrumentation, stage_name: str, iterator: Iterator[T]) -> Iterator[T]:
+    seconds = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                seconds += time.perf_counter() - start
+            yield item
+    finally:
+        collector.record(stage_name, seconds)
+
+# Counters for the common return types
+def count_notes(result: Any) -> int:
+    return 0 if result == None else len(result) if isinstance(result, (list, tuple)) else 1
+
+def dgram_size(result: Any) -> int:
+    if isinstance(result, list):
+        return sum([len(packet.dgram) for packet in result])
+    return len(result.dgram) if result != None else 0
+
+# Tests
+if __name__ == "__main__":
+
+    @timed("double", notes=count_notes)
+    def double(values: list[int]) -> list[int]:
+        return [v * 2 for v in values]
+
+    assert double([1]) == [2] and active() == None
+
+    with instrumented() as stats:
+        double([1, 2, 3])
+        double([4])
+        with stage("block"):
+            double([])
+
+    assert stats.stages["double"].calls == 3 and stats.stages["double"].notes == 4
+    assert stats.stages["block"].calls == 1
+
+    with instrumented() as stats:
+        assert [value for value in timed_iter("doubled", double([1, 2]))] == [2, 4]
+    assert stats.stages["doubled"].calls == 1 and stats.stages["double"].calls == 1
+    assert list(timed_iter("doubled", [1])) == [1]
+    assert [row["total_ms"] for row in stats.report()] == sorted([row["total_ms"] for row in stats.report()], reverse=True)
+    assert "double" in stats.format_report()
+    assert active() == None
@@ -1,16 +1,13 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from decimal import Decimal
-from pythonosc.osc_message import OscMessage
-from pythonosc.osc_packet import OscPacket
-from shuttle_notation.parsing.information_parsing import DynamicArg
+from operator import itemgetter
+from typing import Callable
 import jdw_billboarding.lib.note_utils as note_utils
-from enum import Enum
-from pretty_midi import note_number_to_hz
 from jdw_billboarding.lib.parsing import cut_first
 
 from jdw_billboarding.lib.line_classify import begins_with
 
-from pythonosc import osc_message_builder, udp_client, osc_bundle_builder
+# NOTE: Avoid pythonosc.udp_client here, it drags in asyncio through the dispatcher module
 from pythonosc.osc_bundle import OscBundle
 from pythonosc.osc_message import OscMessage
 from pythonosc.osc_packet import OscPacket
@@ -18,35 +15,52 @@ from pythonosc.osc_packet import OscPacket
 from shuttle_notation import ResolvedElement
 
 from jdw_billboarding.lib.billboard_classes import ElementMessage
+from jdw_billboarding.lib.instrumentation import dgram_size, timed
+from jdw_billboarding.lib.osc_encoding import BUNDLE_HEADER, EncodedBundle, EncodedMessage, encode_bundle, encode_constant_message, encode_message, encode_note_modify, encode_note_on_timed, encode_play_sample, encode_timed_bundle
 
 # TODO: Pass in, somehow...
 SC_DELAY_MS = 70
 
-def create_nrt_preload_bundle(content: list[OscBundle]) -> OscBundle:
+# Max datagram size of a single nrt preload bundle
+# Well below the 65507 byte UDP payload limit, so that the receiving socket buffer does not overflow either
+NRT_PRELOAD_MAX_BYTES = 8192
 
-    content_bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
-    content_bundle.add_content(create_msg("/bundle_info", ["nrt_preload"]))
-
-    nested_bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
+def create_nrt_preload_bundle(content: list[OscBundle]) -> OscBundle:
+    return EncodedBundle(encode_bundle(
+        [encode_constant_message("/bundle_info", ("nrt_preload",))] + [cnt.dgram for cnt in content]
+    ))
+
+# Packs the content into as few nrt preload bundles as possible without any of them exceeding max_size bytes
+# Content that is too large on its own still gets a bundle of its own (and a warning)
+@timed("create_nrt_preload_bundles", size=dgram_size)
+def create_nrt_preload_bundles(content: list[OscBundle], max_size: int = NRT_PRELOAD_MAX_BYTES) -> list[OscBundle]:
+    # "#bundle" + timetag, then the size-prefixed /bundle_info message
+    overhead = len(BUNDLE_HEADER) + 4 + len(encode_constant_message("/bundle_info", ("nrt_preload",)))
+
+    batches: list[list[OscBundle]] = []
+    batch_size = overhead
     for cnt in content:
-        content_bundle.add_content(cnt)
+        cnt_size = 4 + cnt.size
 
-    #content_bundle.add_content(nested_bundle.build())
+        if overhead + cnt_size > max_size:
+            print("WARN: Bundle of", cnt.size, "bytes does not fit in an nrt preload bundle of max", max_size, "bytes")
 
-    return content_bundle.build()
+        if len(batches) == 0 or batch_size + cnt_size > max_size:
+            batches.append([])
+            batch_size = overhead
 
-def create_batch_queue_bundle(queues: list[OscBundle], stop_missing: bool) -> OscBundle:
-    queue_bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
-    queue_bundle.add_content(create_msg("/bundle_info", ["batch_update_queues"]))
-    queue_bundle.add_content(create_msg("/batch_update_queues_info", [1 if stop_missing else 0]))
-
-    nested_bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
-    for queue in queues:
-        nested_bundle.add_content(queue)
+        batches[-1].append(cnt)
+        batch_size += cnt_size
 
-    queue_bundle.add_content(nested_bundle.build())
+    return [create_nrt_preload_bundle(batch) for batch in batches]
 
-    return queue_bundle.build()
+@timed("create_batch_queue_bundle", size=dgram_size)
+def create_batch_queue_bundle(queues: list[OscBundle], stop_missing: bool) -> OscBundle:
+    return EncodedBundle(encode_bundle([
+        encode_constant_message("/bundle_info", ("batch_update_queues",)),
+        encode_constant_message("/batch_update_queues_info", (1 if stop_missing else 0,)),
+        encode_bundle([queue.dgram for queue in queues])
+    ]))
 
 def create_nrt_record_bundle(
     sequence: list[OscBundle], # timed
@@ -55,55 +69,40 @@ def create_nrt_record_bundle(
     bpm: float = 120.0 # TODO: Fix type when the expectation in jdw-sc is corrected
 ) -> OscBundle:
 
-    main_bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
-    note_bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
-
-    for timed_message in sequence:
-        note_bundle.add_content(timed_message)
-
-    main_bundle.add_content(create_msg("/bundle_info", ["nrt_record"]))
-    main_bundle.add_content(create_msg("/nrt_record_info", [bpm, file_name, end_time]))
-    main_bundle.add_content(note_bundle.build())
-
-    return main_bundle.build()
+    return EncodedBundle(encode_bundle([
+        encode_constant_message("/bundle_info", ("nrt_record",)),
+        encode_message("/nrt_record_info", [bpm, file_name, end_time]),
+        encode_bundle([timed_message.dgram for timed_message in sequence])
+    ]))
 
 def create_queue_update_bundle(queue_id: str, timed_osc_msgs: list[OscBundle]) -> OscBundle:
 
     # Building a standard queue_update bundle
-    queue_bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
-    queue_bundle.add_content(create_msg("/bundle_info", ["update_queue"]))
-    queue_bundle.add_content(create_msg("/update_queue_info", [queue_id]))
-
-    note_bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
-
-    for msg in timed_osc_msgs:
-        note_bundle.add_content(msg)
-
-    queue_bundle.add_content(note_bundle.build())
-
-    return queue_bundle.build()
+    return EncodedBundle(encode_bundle([
+        encode_constant_message("/bundle_info", ("update_queue",)),
+        encode_message("/update_queue_info", [queue_id]),
+        encode_bundle([msg.dgram for msg in timed_osc_msgs])
+    ]))
+
+# Compact form of timed messages repeated back to back: jdw-sc plays the contained sequence "repetitions" times
+def create_timed_loop_bundle(repetitions: int, timed_osc_msgs: list[OscBundle]) -> OscBundle:
+    return EncodedBundle(encode_bundle([
+        encode_constant_message("/bundle_info", ("timed_loop",)),
+        encode_message("/timed_loop_info", [repetitions]),
+        encode_bundle([msg.dgram for msg in timed_osc_msgs])
+    ]))
 
 def create_batch_bundle(packets: list[OscPacket]) -> OscBundle:
-    bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
-    bundle.add_content(create_msg("/bundle_info", ["batch-send"]))
-    for packet in packets:
-        bundle.add_content(packet)
-
-    return bundle.build()
+    return EncodedBundle(encode_bundle(
+        [encode_constant_message("/bundle_info", ("batch-send",))] + [packet.dgram for packet in packets]
+    ))
 
 # Basic quick-syntax for OSC message building, ("/s_new, [1,2,3...]")
 def create_msg(adr: str, args: list[str | float | int] = []) -> OscMessage:
-    builder = osc_message_builder.OscMessageBuilder(address=adr)
-    for arg in args:
-        builder.add_arg(arg)
-    return builder.build()
+    return EncodedMessage(encode_message(adr, args))
 
 def to_timed_osc(time: str, osc_packet: OscMessage | OscPacket) -> OscBundle:
-    bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
-    bundle.add_content(create_msg("/bundle_info", ["timed_msg"]))
-    bundle.add_content(create_msg("/timed_msg_info", [time]))
-    bundle.add_content(osc_packet)
-    return bundle.build()
+    return EncodedBundle(encode_timed_bundle(time, osc_packet.dgram))
 
 def is_symbol(element: ResolvedElement, sym: str) -> bool:
     return element.suffix.lower() == sym \
@@ -132,7 +131,7 @@ def resolve_freq(element: ResolvedElement, transpose_steps: int = 0) -> float:
         extra = (12 * (octave + 1)) if octave > 0 else 0
         new_index = index + extra + transpose_steps
 
-        freq = note_number_to_hz(new_index)
+        freq = note_utils.midi_to_hz(new_index)
         return freq
 
     else:
@@ -143,20 +142,72 @@ def resolve_freq(element: ResolvedElement, transpose_steps: int = 0) -> float:
         extra = (12 * (octave - 1)) if octave > 0 else 0
         new_index = letter_check + extra + transpose_steps
 
-        return note_number_to_hz(new_index)
+        return note_utils.midi_to_hz(new_index)
 
+# Flattens args to [key, value, key, value...], with override being a flat key/value list taking precedence
 def args_as_osc(raw_args: dict[str, Decimal], override: list[str | float]):
-    osc_args: list[str | float] = []
-
-    for arg in override:
-        osc_args.append(arg)
+    osc_args: list[str | float] = list(override)
+    override_keys = set(override[0::2])
 
     for arg in raw_args:
-        if arg not in osc_args:
+        if arg not in override_keys:
             osc_args.append(arg)
             osc_args.append(float(raw_args[arg]))
     return osc_args
 
+"""
+    Same output format as args_as_osc, for converting every note of a track with the same override keys.
+    The interleaved key layout is worked out once per distinct set of arg keys, so packing a note is just filling
+    in its values. Notes with the same keys in a different order reuse the first order seen, which keeps the
+    key order stable across the whole track.
+"""
+@dataclass
+class ArgLayout:
+    # [key, None, key, None...] with override keys first, values filled in by ArgPacker.pack
+    template: list[str | float | None]
+    # Fetches the non-override values, in template order, from a raw args dict
+    get_values: Callable[[dict[str, Decimal]], tuple]
+
+def _values_getter(keys: tuple[str, ...]) -> Callable[[dict[str, Decimal]], tuple]:
+    if len(keys) == 0:
+        return lambda raw_args: ()
+    elif len(keys) == 1:
+        return lambda raw_args: (raw_args[keys[0]],)
+    return itemgetter(*keys)
+
+@dataclass
+class ArgPacker:
+    override_keys: tuple[str, ...]
+    # By raw arg keys in the order found in the element, and by key set for notes listing them in another order
+    _layouts: dict[tuple[str, ...], ArgLayout] = field(default_factory=dict, repr=False)
+    _layouts_by_set: dict[frozenset[str], ArgLayout] = field(default_factory=dict, repr=False)
+
+    def _layout(self, keys: tuple[str, ...]) -> ArgLayout:
+        key_set = frozenset(keys)
+        layout = self._layouts_by_set.get(key_set)
+        if layout == None:
+            override_set = set(self.override_keys)
+            raw_keys = tuple([key for key in keys if key not in override_set])
+            template: list[str | float | None] = []
+            for key in self.override_keys + raw_keys:
+                template.append(key)
+                template.append(None)
+            layout = ArgLayout(template, _values_getter(raw_keys))
+            self._layouts_by_set[key_set] = layout
+        self._layouts[keys] = layout
+        return layout
+
+    # override_values in the same order as override_keys
+    def pack(self, raw_args: dict[str, Decimal], override_values: list[float]) -> list[str | float]:
+        keys = tuple(raw_args)
+        layout = self._layouts.get(keys)
+        if layout == None:
+            layout = self._layout(keys)
+
+        osc_args = layout.template.copy()
+        osc_args[1::2] = override_values + list(map(float, layout.get_values(raw_args)))
+        return osc_args # type: ignore
+
 
 
 # Some elements have symbols or other syntax that force a certain osc format
@@ -182,7 +233,7 @@ def resolve_special_message(element: ResolvedElement, instrument_name: str, tran
 def to_note_mod(element: ResolvedElement, external_id_override: str = "", transpose_steps: int = 0) -> OscMessage:
     external_id = resolve_external_id(element) if external_id_override == "" else external_id_override
     osc_args = args_as_osc(element.args, ["freq", resolve_freq(element, transpose_steps)])
-    return create_msg("/note_modify", [external_id, SC_DELAY_MS] + osc_args)
+    return EncodedMessage(encode_note_modify(external_id, SC_DELAY_MS, osc_args))
 
 def to_note_on_timed(element: ResolvedElement, instrument_name: str, transpose_steps: int = 0) -> OscMessage:
     freq = resolve_freq(element, transpose_steps)
@@ -200,13 +251,13 @@ def to_note_on_timed(element: ResolvedElement, instrument_name: str, transpose_s
 
     gate_time = str(sus)
     osc_args = args_as_osc(element.args, ["freq", freq])
-    return create_msg("/note_on_timed", [instrument_name, external_id, gate_time, SC_DELAY_MS] + osc_args)
+    return EncodedMessage(encode_note_on_timed(instrument_name, external_id, gate_time, SC_DELAY_MS, osc_args))
 
 def to_play_sample(element: ResolvedElement, instrument_name: str) -> OscMessage:
     osc_args = args_as_osc(element.args, ["freq", resolve_freq(element)])
-    return create_msg("/play_sample", [
-        resolve_external_id(element), instrument_name, element.index, element.prefix, SC_DELAY_MS
-    ] + osc_args)
+    return EncodedMessage(encode_play_sample(
+        resolve_external_id(element), instrument_name, element.index, element.prefix, SC_DELAY_MS, osc_args
+    ))
 
 def to_note_on(element: ResolvedElement, instrument_name: str, external_id_override: str = "", transpose_steps: int = 0) -> OscMessage:
     external_id = resolve_external_id(element) if external_id_override == "" else external_id_override
@@ -1,7 +1,10 @@
 # Rewrite of the billboarding library, focusing on less messy code at the end of the explorative phase
 
+import re
 from dataclasses import dataclass
 from enum import Enum
+from typing import Iterable, Iterator
+from jdw_billboarding.lib.instrumentation import timed
 
 FILTER_HEADER: str = ">>> "
 SYNTH_HEADER_HEADER: str = "@"
@@ -29,51 +32,100 @@ class BillboardLine:
     type: BillboardLineType
 
 def is_commented(line: str):
-    return "#" in line.strip() and line.strip()[0] == "#"
+    return line.strip().startswith(COMMENT_SYMBOL)
 
 def decomment(line: str) -> str:
-    return decomment("".join(line[1:])) if is_commented(line) else line
+    while is_commented(line):
+        line = line[1:]
+    return line
+
+# Tabs and 4-space indents of one line (with any continuations already joined), stripped
+def normalize_line(line: str) -> str:
+    # Stripping first gives the same result, and most lines then need neither replace
+    line = line.strip()
+    if "\t" in line:
+        line = line.replace("\t", " ")
+    if "    " in line:
+        line = line.replace("    ", " ")
+    return line
+
+# Stream stripped lines, treating backslash as line continuation; only ever copies one line of the source at a time
+def iter_lines(source: str) -> Iterator[str]:
+    continued: list[str] = [] # Physical lines joined by backslash continuation so far
+    find = source.find
+    start = 0
+    while True:
+        end = find("\n", start)
+        piece = source[start:end] if end != -1 else source[start:]
+        if end != -1 and piece.endswith("\\"):
+            continued.append(piece[:-1])
+        elif len(continued) > 0:
+            continued.append(piece)
+            yield normalize_line("".join(continued))
+            continued.clear()
+        else:
+            yield normalize_line(piece)
+        if end == -1:
+            return
+        start = end + 1
 
 # Split by newline, treating backslash as line continuation
 def line_split(source: str) -> list[str]:
-    de_broken = source.replace("\\\n", "")
-    return [line.strip().replace("\t", " ").replace("    ", " ") for line in de_broken.split("\n")]
+    return list(iter_lines(source))
 
 def begins_with(source: str, beginning: str) -> bool:
-    clean_source = source.strip()
-    return len(clean_source) >= len(beginning) and "".join(clean_source[0:len(beginning)]) == beginning
+    return source.strip().startswith(beginning)
 
-# Return all lines unaltered and in order, classified for later parsing
-def classify_lines(billboard_string: str) -> list[BillboardLine]:
+# Line types recognised from the first character of the (decommented) content
+_PREFIX_DISPATCH: dict[str, tuple[str, BillboardLineType]] = {
+    FILTER_HEADER[0]: (FILTER_HEADER, BillboardLineType.GROUP_FILTER),
+    SYNTH_HEADER_HEADER: (SYNTH_HEADER_HEADER, BillboardLineType.SYNTH_HEADER),
+    SELECTION_MARKER: (SELECTION_MARKER, BillboardLineType.SYNTH_HEADER),
+    EFFECT_DEF_HEADER: (EFFECT_DEF_HEADER, BillboardLineType.EFFECT_DEFINITION),
+}
+_COMMAND_PREFIXES = tuple(COMMAND_SYMBOLS)
+
+# Leading comment symbols (and whitespace between them), i.e. decomment() followed by strip()
+_DECOMMENT = re.compile(r"[\s#]*")
+
+# Yield lines unaltered and in order, classified for later parsing, in a single pass over the source
+def iter_classified_lines(billboard_string: str) -> Iterator[BillboardLine]:
+    return classify_line_stream(iter_lines(billboard_string))
 
-    classified_lines: list[BillboardLine] = []
+# As above, for lines that have already been split and normalized (see iter_lines/normalize_line)
+def classify_line_stream(lines: Iterable[str]) -> Iterator[BillboardLine]:
 
     tracks_started = False
 
-    for line in line_split(billboard_string):
+    for line in lines:
+
+        if line == "":
+            continue
 
         # Peek into post-comment content, to allow detection of commented types
-        decommented = decomment(line) if is_commented(line) else line
-
-        if begins_with(decommented, FILTER_HEADER):
-            classified_lines.append(BillboardLine(line, BillboardLineType.GROUP_FILTER))
-        elif begins_with(decommented, SYNTH_HEADER_HEADER) or begins_with(decommented, SELECTION_MARKER):
-            classified_lines.append(BillboardLine(line, BillboardLineType.SYNTH_HEADER))
-            tracks_started = True
-        elif begins_with(decommented, EFFECT_DEF_HEADER):
-            classified_lines.append(BillboardLine(line, BillboardLineType.EFFECT_DEFINITION))
+        commented = line[0] == COMMENT_SYMBOL
+        decommented = line[_DECOMMENT.match(line).end():] if commented else line
+
+        dispatch = _PREFIX_DISPATCH.get(decommented[0:1])
+        if dispatch != None and decommented.startswith(dispatch[0]):
+            if dispatch[1] == BillboardLineType.SYNTH_HEADER:
+                tracks_started = True
+            yield BillboardLine(line, dispatch[1])
         elif tracks_started and decommented != "":
-            classified_lines.append(BillboardLine(line, BillboardLineType.TRACK_DEFINITION))
-        elif any([begins_with(decommented, s) for s in COMMAND_SYMBOLS]):
-            classified_lines.append(BillboardLine(line, BillboardLineType.COMMAND))
-        elif begins_with(line, "#"):
-            classified_lines.append(BillboardLine(line, BillboardLineType.COMMENT))
-        elif begins_with(line, DEFAULT_STATEMENT):
-            classified_lines.append(BillboardLine(line, BillboardLineType.DEFAULT_STATEMENT))
-        elif line != "": # Ignore empty
+            yield BillboardLine(line, BillboardLineType.TRACK_DEFINITION)
+        elif decommented.startswith(_COMMAND_PREFIXES):
+            yield BillboardLine(line, BillboardLineType.COMMAND)
+        elif commented:
+            yield BillboardLine(line, BillboardLineType.COMMENT)
+        elif line.startswith(DEFAULT_STATEMENT):
+            yield BillboardLine(line, BillboardLineType.DEFAULT_STATEMENT)
+        else:
             print("WARN: could not classify line", line)
 
-    return classified_lines
+# Return all lines unaltered and in order, classified for later parsing
+@timed("classify_lines")
+def classify_lines(billboard_string: str) -> list[BillboardLine]:
+    return list(iter_classified_lines(billboard_string))
 
 # Tests
 if __name__ == "__main__":
@@ -99,3 +151,10 @@ if __name__ == "__main__":
     assert classify_lines("# hello")[0].type == BillboardLineType.COMMENT
     assert classify_lines("€yeah")[0].type == BillboardLineType.EFFECT_DEFINITION
     assert classify_lines("@synth\nsomthing")[1].type == BillboardLineType.TRACK_DEFINITION
+
+    # Continuations, tabs and indents
+    assert line_split("a\\\nb\n\t c  \n        d") == ["ab", "c", "d"]
+    assert list(iter_lines("a\\\nb\n\t c  \n        d")) == line_split("a\\\nb\n\t c  \n        d")
+    assert [line.type for line in classify_lines("# #@synth\n#\n    x")] \
+        == [BillboardLineType.SYNTH_HEADER, BillboardLineType.COMMENT, BillboardLineType.TRACK_DEFINITION]
+    assert classify_lines("#COMMAND /set_bpm 120\nDEFAULT amp1")[1].type == BillboardLineType.DEFAULT_STATEMENT
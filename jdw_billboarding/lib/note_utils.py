@@ -1,4 +1,7 @@
 from decimal import Decimal
+from functools import lru_cache
+from operator import itemgetter
+from typing import Sequence
 
 
 """
@@ -63,10 +66,16 @@ def _generate_scale(root_note: int, scale_type_key: str) -> list[int]:
 
     return sorted(list(set(chromatic_indices)))
 
+# Scales are generated once per root/type, since the same few are used for every note of a billboard
+@lru_cache(maxsize=128)
+def scale_table(root_note: int, scale_type_key: str) -> tuple[int, ...]:
+    return tuple(_generate_scale(root_note, scale_type_key))
+
 # Note_id: typically the index of your note; "I want to play note 22 in c maj7"
+@lru_cache(maxsize=4096)
 def resolve_index(note_id: int, scale_root_letter: str, scale_type_key: str) -> int:
     root_note = MIDI_MAP[scale_root_letter] if scale_root_letter in MIDI_MAP else 0
-    my_scale = _generate_scale(root_note, scale_type_key)
+    my_scale = scale_table(root_note, scale_type_key)
     scale_indices = len(my_scale) - 1
     raw_scaled_index = get_in_list(note_id, my_scale)
     added_octaves = int(note_id / scale_indices) if note_id / scale_indices > 1 else 0
@@ -74,7 +83,7 @@ def resolve_index(note_id: int, scale_root_letter: str, scale_type_key: str) ->
     return raw_scaled_index + added_value
 
 # Loop around list until index fits it
-def get_in_list(raw_index: int, my_list: list[int]) -> int:
+def get_in_list(raw_index: int, my_list: list[int] | tuple[int, ...]) -> int:
 
     indices_in_list = len(my_list) - 1
     times = raw_index / indices_in_list
@@ -114,6 +123,35 @@ SCALES: dict[str, list[int]] = {
 }
 
 
+# Standard 440hz tuning, (fractional) semitones relative to C0
+# Same formula as pretty_midi.note_number_to_hz, without importing pretty_midi (and with it numpy/mido) at startup
+def note_number_to_hz(note_number: int | float) -> float:
+    return 440.0 * (2.0 ** ((note_number - 69) / 12.0))
+
+# Frequencies of all standard midi notes; anything outside (or fractional) is calculated on demand
+MIDI_HZ: tuple[float, ...] = tuple(note_number_to_hz(note_number) for note_number in range(128))
+
+def midi_to_hz(note_number: int | float) -> float:
+    if type(note_number) is int and 0 <= note_number < 128:
+        return MIDI_HZ[note_number]
+    return note_number_to_hz(note_number)
+
+# midi_to_hz(note + transpose_steps) for each standard midi note
+@lru_cache(maxsize=64)
+def transposed_hz_table(transpose_steps: int) -> tuple[float, ...]:
+    return tuple(midi_to_hz(note_number + transpose_steps) for note_number in range(128))
+
+# midi_to_hz for a whole track of notes: a single table gather when every note is a standard midi note
+def midis_to_hz(note_numbers: Sequence[int], transpose_steps: int = 0) -> list[float]:
+    if len(note_numbers) == 0:
+        return []
+    if len(note_numbers) > 1 and 0 <= min(note_numbers) and max(note_numbers) < 128:
+        try:
+            return list(itemgetter(*note_numbers)(transposed_hz_table(transpose_steps)))
+        except TypeError:
+            pass # Fractional note numbers
+    return [midi_to_hz(note_number + transpose_steps) for note_number in note_numbers]
+
 def note_letter_to_midi(note_string: str) -> int:
 
     if note_string in MIDI_MAP:
@@ -128,3 +166,13 @@ if __name__ == "__main__":
     assert cmaj == [0, 2, 4, 5, 7, 9, 11], cmaj
     resolved = [resolve_index(i, "c", "maj") for i in [0, 1, 2, 3, 4, 5, 6, 7]]
     assert resolved == [0, 2, 4, 5, 7, 9, 11, 12], resolved
+    assert scale_table(4, "maj") == tuple(_generate_scale(4, "maj"))
+
+    assert midi_to_hz(69) == 440.0
+    assert midi_to_hz(60) == 261.6255653005986
+    assert all(midi_to_hz(n) == note_number_to_hz(n) for n in range(-12, 140))
+    assert midi_to_hz(69.5) == note_number_to_hz(69.5)
+    assert midis_to_hz([60, 69, -3, 127], 1) == [midi_to_hz(n + 1) for n in [60, 69, -3, 127]]
+    assert midis_to_hz([60, 69], 3) == [midi_to_hz(63), midi_to_hz(72)]
+    assert midis_to_hz([69.5, 70]) == [midi_to_hz(69.5), midi_to_hz(70)]
+    assert midis_to_hz([69]) == [440.0] and midis_to_hz([]) == []
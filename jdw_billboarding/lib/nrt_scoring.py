@@ -1,89 +1,190 @@
-
+import hashlib
+from array import array
 from decimal import Decimal
 from pythonosc.osc_bundle import OscBundle
 from shuttle_notation.parsing.element import ResolvedElement
-from jdw_billboarding.lib.jdw_osc_utils import ElementMessage, create_msg, to_timed_osc
+from jdw_billboarding.lib.beat_ticks import ticks_to_beats, ticks_to_str
+from jdw_billboarding.lib.instrumentation import timed
+from jdw_billboarding.lib.jdw_osc_utils import ElementMessage, create_msg, create_timed_loop_bundle, to_timed_osc
 from dataclasses import dataclass, field
+from typing import Iterator
 
 from jdw_billboarding.lib.billboard_classes import BillboardTrack
 
-def element_beats(element: ElementMessage) -> Decimal:
-    return Decimal(element.get_time())
-
-def source_len(elements: list[ElementMessage]) -> Decimal:
-    res = sum([element_beats(element) for element in elements])
-    return res if isinstance(res, Decimal) else Decimal("0.0")
+# Timeline index marking silence padding instead of a source element
+SILENCE: int = -1
 
-@dataclass
+@dataclass(slots=True)
 class TrackSource:
     elements: list[ElementMessage]
     group_name: str
+    # Length of each element in ticks, and their sum
+    ticks: array = field(default_factory=lambda: array("q"))
+    length: int = 0
+
+# Play the whole track source this many times, then stay silent for pad_ticks
+@dataclass(slots=True)
+class Segment:
+    repetitions: int
+    pad_ticks: int = 0
+
+# Timeline of a track as segments, only expanded into notes when exported.
+# Any silence is added to the last segment, so a segment with pad_ticks is always followed by repetitions.
+@dataclass(slots=True)
+class Timeline:
+    segments: list[Segment] = field(default_factory=list)
+    length: int = 0
+
+# Marks repetitions that were left as a loop in compact output, see Score.iter_entries
+@dataclass(slots=True)
+class Loop:
+    repetitions: int
 
 # NONE allows for silece padding
-@dataclass
+@dataclass(slots=True)
 class ScoreMessage:
     message: ElementMessage | None
-    time: Decimal
+    ticks: int
 
-def total_beats(elements: list[ScoreMessage]) -> Decimal:
-    res = sum([element.time for element in elements])
-    return res if isinstance(res, Decimal) else Decimal("0.0")
+def total_ticks(elements: list[ScoreMessage]) -> int:
+    return sum([element.ticks for element in elements])
 
 @dataclass
 class Score:
     track_sources: dict[str, TrackSource] = field(default_factory=dict)
-    tracks: dict[str, list[ScoreMessage]] = field(default_factory=dict)
+    timelines: dict[str, Timeline] = field(default_factory=dict)
+
+    # Unmerged timeline entries as (source index or SILENCE, ticks), expanded lazily
+    def iter_timeline(self, track_name: str) -> Iterator[tuple[int, int]]:
+        source_ticks = self.track_sources[track_name].ticks
+        for segment in self.timelines[track_name].segments:
+            for _ in range(segment.repetitions):
+                yield from enumerate(source_ticks)
+            if segment.pad_ticks > 0:
+                yield SILENCE, segment.pad_ticks
+
+    """
+        Export entries as (source index, ticks), with silence merged into the previous entry, expanded lazily.
+        With compact_loops, runs of two or more whole repetitions are yielded as a single Loop instead. The last
+        repetition before a pad is always expanded, since the pad is merged into its final note.
+    """
+    def iter_entries(self, track_name: str, compact_loops: bool = False) -> Iterator[tuple[int, int] | Loop]:
+        source_ticks = self.track_sources[track_name].ticks
+        pending: tuple[int, int] | None = None # Held back so that following silence can be added to it
+
+        for segment in self.timelines[track_name].segments:
+            repetitions = segment.repetitions
+
+            if compact_loops and len(source_ticks) > 0:
+                looped = repetitions - 1 if segment.pad_ticks > 0 else repetitions
+                if looped > 1:
+                    if pending != None:
+                        yield pending
+                        pending = None
+                    yield Loop(looped)
+                    repetitions -= looped
+
+            for _ in range(repetitions):
+                for entry in enumerate(source_ticks):
+                    if pending != None:
+                        yield pending
+                    pending = entry
+
+            if segment.pad_ticks > 0:
+                pending = (pending[0], pending[1] + segment.pad_ticks) if pending != None else (SILENCE, segment.pad_ticks)
+
+        if pending != None:
+            yield pending
+
+    # Digest of everything the exported bundles of a track depend on: its source messages and its arranged timeline
+    def track_digest(self, track_name: str) -> bytes:
+        source = self.track_sources[track_name]
+        timeline = self.timelines[track_name]
+        digest = hashlib.blake2b(digest_size=16)
+        for element in source.elements:
+            dgram = element.osc.dgram
+            digest.update(len(dgram).to_bytes(4, "big"))
+            digest.update(dgram)
+        digest.update(source.ticks.tobytes())
+        digest.update(array("q", [value for segment in timeline.segments for value in (segment.repetitions, segment.pad_ticks)]).tobytes())
+        return digest.digest()
 
     # Export a finished set of tracks from the modifications done by extend() and pad()
-    def unpack_timed_tracks(self) -> dict[str, list[OscBundle]]:
+    # Passing a track_cache from a previous export reuses the bundles of every track whose digest is unchanged;
+    # the cache is then replaced in-place with the tracks of this export.
+    # compact_loops sends repetitions as timed_loop bundles (see create_timed_loop_bundle), which jdw-sc must support.
+    @timed("unpack_timed_tracks")
+    def unpack_timed_tracks(self, track_cache: dict[str, tuple[bytes, list[OscBundle]]] | None = None, compact_loops: bool = False) -> dict[str, list[OscBundle]]:
         export_dict: dict[str, list[OscBundle]] = {}
+        digests: dict[str, bytes] = {}
 
         # Compress messages so that silence gets appended to the previous note
         # This declutters the final score object in supercollider but isn't strictly important
-        # TODO: Destructive operation, maybe place elsewhere
-        for track_name in self.tracks:
-
-            new_set: list[ScoreMessage] = []
-
-            for msg in self.tracks[track_name]:
-                if not isinstance(msg.message, ElementMessage):
-                    if len(new_set) > 0:
-                        new_set[-1].time += msg.time
-                    else:
-                        new_set.append(msg)
+        empty_message = create_msg("/empty_message", [])
+        for track_name in self.timelines:
+
+            if track_cache != None:
+                digests[track_name] = self.track_digest(track_name) + (b"L" if compact_loops else b"")
+                cached = track_cache.get(track_name)
+                if cached != None and cached[0] == digests[track_name]:
+                    export_dict[track_name] = cached[1]
+                    continue
+
+            source = self.track_sources[track_name]
+            loop_body: list[OscBundle] | None = None
+            timed_msgs: list[OscBundle] = []
+            for entry in self.iter_entries(track_name, compact_loops):
+                if isinstance(entry, Loop):
+                    if loop_body == None:
+                        loop_body = [to_timed_osc(ticks_to_str(ticks), source.elements[index].osc) for index, ticks in enumerate(source.ticks)]
+                    timed_msgs.append(create_timed_loop_bundle(entry.repetitions, loop_body))
                 else:
-                    new_set.append(msg)
+                    index, ticks = entry
+                    timed_msgs.append(to_timed_osc(ticks_to_str(ticks), source.elements[index].osc if index != SILENCE else empty_message))
+            export_dict[track_name] = timed_msgs
 
-            self.tracks[track_name] = new_set
-
-        for track_name in self.tracks:
-            export_dict[track_name] = []
-            for msg in self.tracks[track_name]:
-                if isinstance(msg.message, ElementMessage):
-                    timed_bundle = to_timed_osc(str(msg.time.normalize()), msg.message.osc)
-                    export_dict[track_name].append(timed_bundle)
-                else:
-                    timed_bundle = to_timed_osc(str(msg.time.normalize()), create_msg("/empty_message", []))
-                    export_dict[track_name].append(timed_bundle)
+        if track_cache != None:
+            track_cache.clear()
+            track_cache.update({track_name: (digests[track_name], export_dict[track_name]) for track_name in export_dict})
 
         return export_dict
 
+    # Materialised view of a timeline, e.g. for inspection; not used by the export itself
+    def get_track_messages(self, track_name: str) -> list[ScoreMessage]:
+        elements = self.track_sources[track_name].elements
+        return [
+            ScoreMessage(elements[index] if index != SILENCE else None, ticks)
+            for index, ticks in self.iter_timeline(track_name)
+        ]
+
     def add_source(self, track_name: str, track_group: str, elements: list[ElementMessage]):
-        self.track_sources[track_name] = TrackSource(elements, track_group)
-        self.tracks[track_name] = []
+        ticks = array("q", [ele.ticks for ele in elements])
+        self.track_sources[track_name] = TrackSource(elements, track_group, ticks, sum(ticks))
+        self.timelines[track_name] = Timeline()
+
+    def extend_track(self, track_name: str, repetitions: int = 1):
+        timeline = self.timelines[track_name]
 
-    def extend_track(self, track_name: str):
-        source_track = self.track_sources[track_name]
-        timeline_track = self.tracks[track_name]
+        if len(timeline.segments) > 0 and timeline.segments[-1].pad_ticks == 0:
+            timeline.segments[-1].repetitions += repetitions
+        else:
+            timeline.segments.append(Segment(repetitions))
+        timeline.length += self.track_sources[track_name].length * repetitions
 
-        for ele in source_track.elements:
-            timeline_track.append(ScoreMessage(ele, element_beats(ele)))
+    def pad_track(self, track_name: str, ticks: int):
+        timeline = self.timelines[track_name]
 
-    def pad_track(self, track_name: str, beats: Decimal):
-        self.tracks[track_name].append(ScoreMessage(None, beats))
+        if len(timeline.segments) > 0:
+            timeline.segments[-1].pad_ticks += ticks
+        else:
+            timeline.segments.append(Segment(0, ticks))
+        timeline.length += ticks
 
-    def get_end_time(self):
-        return max([total_beats(self.tracks[track_name]) for track_name in self.tracks])
+    def get_end_ticks(self) -> int:
+        return max([timeline.length for timeline in self.timelines.values()])
+
+    def get_end_time(self) -> Decimal:
+        return ticks_to_beats(self.get_end_ticks())
 
     def extend_groups(self, group_names: list[str], also_extend_groupless: bool = True):
 
@@ -100,32 +201,35 @@ class Score:
 
         # Determine longest extending source material
         longest_track_name = None
+        cur_longest = 0
         for key in track_names:
-
-            cur_longest = source_len(self.track_sources[longest_track_name].elements) if longest_track_name != None else Decimal("0.0")
-
-            this_len = source_len(self.track_sources[key].elements)
-
-
+            this_len = self.track_sources[key].length
             if this_len > cur_longest:
                 longest_track_name = key
+                cur_longest = this_len
 
         if isinstance(longest_track_name, str):
             self.extend_track(longest_track_name)
-            goal_time = total_beats(self.tracks[longest_track_name])
+            goal_time = self.timelines[longest_track_name].length
 
+            extending = set(track_names)
 
             for track_name in self.track_sources:
-                slen = source_len(self.track_sources[track_name].elements)
 
-                if track_name != longest_track_name:
+                if track_name == longest_track_name:
+                    continue
 
-                    if total_beats(self.tracks[track_name]) < goal_time:
-                        while total_beats(self.tracks[track_name]) < goal_time:
-                            diff = goal_time - total_beats(self.tracks[track_name])
+                diff = goal_time - self.timelines[track_name].length
+                if diff <= 0:
+                    continue
 
-                            if diff >= slen and track_name in track_names:
+                # Fit as many whole repetitions as possible, then pad the remainder with silence
+                slen = self.track_sources[track_name].length
+                if track_name in extending and slen > 0:
+                    repetitions = diff // slen
+                    if repetitions > 0:
+                        self.extend_track(track_name, repetitions)
+                        diff -= slen * repetitions
 
-                                self.extend_track(track_name)
-                            else:
-                                self.pad_track(track_name, diff)
+                if diff > 0:
+                    self.pad_track(track_name, diff)
@@ -0,0 +1,200 @@
+# Purpose: Fast OSC datagram encoding for the high-volume parts of queue and nrt building.
+#   Output is byte-identical to what pythonosc's OscMessageBuilder/OscBundleBuilder produce, but constant
+#   messages are encoded once and nested bundles are not parsed back into objects at every level.
+
+import struct
+from functools import lru_cache
+from typing import Any, Iterable
+
+from pythonosc import osc_message_builder
+from pythonosc.osc_bundle import OscBundle
+from pythonosc.osc_message import OscMessage
+from pythonosc.parsing import osc_types
+
+_pack_int = struct.Struct(">i").pack
+_pack_int64 = struct.Struct(">q").pack
+_pack_float = struct.Struct(">f").pack
+
+BUNDLE_PREFIX = b"#bundle\x00"
+BUNDLE_HEADER = BUNDLE_PREFIX + osc_types.write_date(osc_types.IMMEDIATELY)
+
+# Addresses, arg keys, instrument names and type tags repeat for nearly every note
+@lru_cache(maxsize=4096)
+def encode_string(value: str) -> bytes:
+    return osc_types.write_string(value)
+
+# Returns the type tag character and encoded value for the arg types used by billboarding
+# None signals that pythonosc's builder has to handle the arg (arrays, midi, blobs...)
+def _encode_arg(arg: Any) -> tuple[str, bytes] | None:
+    arg_type = type(arg)
+    if arg_type is str:
+        return "s", encode_string(arg)
+    elif arg_type is float:
+        return "f", _pack_float(arg)
+    elif arg_type is int:
+        return ("h", _pack_int64(arg)) if arg.bit_length() > 31 else ("i", _pack_int(arg))
+    elif arg is True:
+        return "T", b""
+    elif arg is False:
+        return "F", b""
+    elif arg is None:
+        return "N", b""
+    elif isinstance(arg, str):
+        return "s", encode_string(str(arg))
+    elif isinstance(arg, float):
+        return "f", _pack_float(float(arg))
+    elif isinstance(arg, int):
+        return _encode_arg(int(arg))
+    return None
+
+def _build_with_pythonosc(address: str, args: Iterable[Any]) -> bytes:
+    builder = osc_message_builder.OscMessageBuilder(address=address)
+    for arg in args:
+        builder.add_arg(arg)
+    return builder.build().dgram
+
+def encode_message(address: str, args: list[Any]) -> bytes:
+    if not address:
+        # Let pythonosc raise its usual BuildError
+        return _build_with_pythonosc(address, args)
+
+    type_tags = [","]
+    encoded_args: list[bytes] = []
+    for arg in args:
+        encoded = _encode_arg(arg)
+        if encoded == None:
+            return _build_with_pythonosc(address, args)
+        type_tags.append(encoded[0])
+        encoded_args.append(encoded[1])
+
+    return encode_string(address) + encode_string("".join(type_tags)) + b"".join(encoded_args)
+
+# For messages that never change, e.g. /bundle_info update_queue
+@lru_cache(maxsize=256)
+def encode_constant_message(address: str, args: tuple = ()) -> bytes:
+    return encode_message(address, list(args))
+
+# Encodes a message whose leading args have known types, followed by the [key, value, key, value...] list
+# produced by args_as_osc. Skips type inference for every arg that fits the usual str/float pattern.
+def encode_keyed_message(address: str, head_tags: str, head: list[bytes], osc_args: list[Any]) -> bytes:
+    type_tags = [",", head_tags]
+    encoded_args: list[bytes] = head.copy()
+    for arg in osc_args:
+        arg_type = type(arg)
+        if arg_type is str:
+            type_tags.append("s")
+            encoded_args.append(encode_string(arg))
+        elif arg_type is float:
+            type_tags.append("f")
+            encoded_args.append(_pack_float(arg))
+        else:
+            encoded = _encode_arg(arg)
+            if encoded == None:
+                raise ValueError("Unsupported keyed arg type for " + address + ": " + str(arg_type))
+            type_tags.append(encoded[0])
+            encoded_args.append(encoded[1])
+
+    return encode_string(address) + encode_string("".join(type_tags)) + b"".join(encoded_args)
+
+def encode_note_on_timed(instrument_name: str, external_id: str, gate_time: str, delay_ms: int, osc_args: list[Any]) -> bytes:
+    return encode_keyed_message("/note_on_timed", "sssi", [
+        encode_string(instrument_name), encode_string(external_id), encode_string(gate_time), _pack_int(delay_ms)
+    ], osc_args)
+
+def encode_play_sample(external_id: str, pack_name: str, index: int, category: str, delay_ms: int, osc_args: list[Any]) -> bytes:
+    index_tag, index_bytes = _encode_arg(index) or ("i", _pack_int(int(index)))
+    return encode_keyed_message("/play_sample", "ss" + index_tag + "si", [
+        encode_string(external_id), encode_string(pack_name), index_bytes, encode_string(category), _pack_int(delay_ms)
+    ], osc_args)
+
+def encode_note_modify(external_id: str, delay_ms: int, osc_args: list[Any]) -> bytes:
+    return encode_keyed_message("/note_modify", "si", [encode_string(external_id), _pack_int(delay_ms)], osc_args)
+
+def encode_bundle(contents: Iterable[bytes]) -> bytes:
+    parts: list[bytes] = [BUNDLE_HEADER]
+    for dgram in contents:
+        parts.append(_pack_int(len(dgram)))
+        parts.append(dgram)
+    return b"".join(parts)
+
+# Everything up to the time string of a /bundle_info timed_msg bundle is the same for every note
+_TIMED_BUNDLE_INFO = encode_constant_message("/bundle_info", ("timed_msg",))
+_TIMED_BUNDLE_PREFIX = BUNDLE_HEADER + _pack_int(len(_TIMED_BUNDLE_INFO)) + _TIMED_BUNDLE_INFO
+_TIMED_INFO_PREFIX = encode_string("/timed_msg_info") + encode_string(",s")
+
+def encode_timed_bundle(time: str, dgram: bytes) -> bytes:
+    info = _TIMED_INFO_PREFIX + encode_string(time)
+    return _TIMED_BUNDLE_PREFIX + _pack_int(len(info)) + info + _pack_int(len(dgram)) + dgram
+
+# OscMessage for a datagram encoded above; only parsed back if its address or params are read
+class EncodedMessage(OscMessage):
+
+    def __init__(self, dgram: bytes) -> None:
+        self._dgram = dgram
+
+    def __getattr__(self, name: str) -> Any:
+        if name in ("_address_regexp", "_parameters"):
+            self._parameters = []
+            self._parse_datagram()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+# OscBundle for a datagram encoded above; nested contents are only parsed if they are read
+class EncodedBundle(OscBundle):
+
+    def __init__(self, dgram: bytes) -> None:
+        self._dgram = dgram
+
+    def __getattr__(self, name: str) -> Any:
+        if name in ("_timestamp", "_contents"):
+            self._timestamp, index = osc_types.get_date(self._dgram, len(BUNDLE_PREFIX))
+            self._contents = self._parse_contents(index)
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+# Tests
+if __name__ == "__main__":
+
+    from pythonosc import osc_bundle_builder
+
+    def reference_msg(adr: str, args: list[Any]) -> OscMessage:
+        builder = osc_message_builder.OscMessageBuilder(address=adr)
+        for arg in args:
+            builder.add_arg(arg)
+        return builder.build()
+
+    def reference_bundle(contents: list[Any]) -> OscBundle:
+        builder = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
+        for content in contents:
+            builder.add_content(content)
+        return builder.build()
+
+    keyed = ["freq", 261.6255653005986, "amp", 0.7, "sus", 0.25]
+    cases: list[tuple[str, list[Any]]] = [
+        ("/empty_msg", []),
+        ("/bundle_info", ["timed_msg"]),
+        ("/set_bpm", [120]),
+        ("/nrt_record_info", [120.0, "track_a.wav", 12.5]),
+        ("/keyboard_pad_samples", [1, 0, 2, 14, 2**40, -3]),
+        ("/odd", [True, False, None, "abc", "abcd", ""]),
+        ("/note_on", ["router", "effect_router_1.0_2.0", 0, "in", 1.0, "out", 2.0]),
+    ]
+    for adr, args in cases:
+        assert encode_message(adr, args) == reference_msg(adr, args).dgram, adr
+
+    assert encode_note_on_timed("blip", "0_blip_00_{nodeId}", "0.25", 70, keyed) \
+        == reference_msg("/note_on_timed", ["blip", "0_blip_00_{nodeId}", "0.25", 70] + keyed).dgram
+    assert encode_play_sample("id", "Roland808", 14, "", 70, keyed) \
+        == reference_msg("/play_sample", ["id", "Roland808", 14, "", 70] + keyed).dgram
+    assert encode_note_modify("effect_a_1", 70, keyed) == reference_msg("/note_modify", ["effect_a_1", 70] + keyed).dgram
+
+    note = reference_msg("/note_modify", ["effect_a_1", 70] + keyed)
+    timed = reference_bundle([reference_msg("/bundle_info", ["timed_msg"]), reference_msg("/timed_msg_info", ["0.5"]), note])
+    assert encode_timed_bundle("0.5", note.dgram) == timed.dgram
+    assert encode_bundle([timed.dgram, note.dgram]) == reference_bundle([timed, note]).dgram
+
+    lazy_msg = EncodedMessage(note.dgram)
+    assert lazy_msg.address == note.address and lazy_msg.params == note.params
+    lazy_bundle = EncodedBundle(timed.dgram)
+    assert lazy_bundle.num_contents == 3 and lazy_bundle.timestamp == timed.timestamp
+    assert reference_bundle([lazy_bundle, lazy_msg]).dgram == encode_bundle([timed.dgram, note.dgram])
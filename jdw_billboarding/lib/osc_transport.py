@@ -0,0 +1,281 @@
+# Purpose: Sending billboard_running output to jdw-sc over UDP, so that clients don't each need their own send loop.
+#   Packets go out as their already encoded .dgram over one reused socket. UDP has no flow control, so large outputs
+#   (e.g. thousands of NRT preload batches) can be paced to keep the receiving socket buffer from overflowing.
+#
+# NOTE: Not imported by billboard_running, since asyncio alone would eat most of its import time budget
+
+import asyncio
+import socket
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterable, Iterable
+
+from pythonosc.osc_bundle import OscBundle
+from pythonosc.osc_message import OscMessage
+
+# Max size of a UDP datagram
+MAX_DATAGRAM_BYTES = 65507
+
+@dataclass
+class Pacing:
+    # Minimum time between two packets, and an upper limit on throughput (0 disables either)
+    packet_interval_s: float = 0.0
+    max_bytes_per_second: int = 0
+    _next_send: float = field(default=0.0, init=False, repr=False)
+
+    # Seconds to wait before a packet of the given size may be sent; reserves the slot for it
+    def reserve(self, size: int) -> float:
+        now = time.monotonic()
+        start = max(now, self._next_send)
+        spacing = self.packet_interval_s
+        if self.max_bytes_per_second > 0:
+            spacing = max(spacing, size / self.max_bytes_per_second)
+        self._next_send = start + spacing
+        return start - now
+
+def _resolve_address(host: str, port: int) -> tuple[socket.AddressFamily, tuple]:
+    family, _, _, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+    return family, address
+
+# Blocking sender, for scripts and clients without an event loop
+@dataclass
+class OscSender:
+    host: str
+    port: int
+    pacing: Pacing = field(default_factory=Pacing)
+    _socket: socket.socket = field(init=False, repr=False)
+    _address: tuple = field(init=False, repr=False)
+
+    def __post_init__(self):
+        family, self._address = _resolve_address(self.host, self.port)
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+
+    def send(self, packet: OscMessage | OscBundle):
+        dgram = packet.dgram
+        wait = self.pacing.reserve(len(dgram))
+        if wait > 0:
+            time.sleep(wait)
+        self._socket.sendto(dgram, self._address)
+
+    def send_all(self, packets: Iterable[OscMessage | OscBundle]) -> int:
+        count = 0
+        for packet in packets:
+            self.send(packet)
+            count += 1
+        return count
+
+    def close(self):
+        self._socket.close()
+
+    def __enter__(self) -> "OscSender":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class _SenderProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self) -> None:
+        # Cleared by the transport while its write buffer is above the high-water mark
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+
+    def pause_writing(self) -> None:
+        self.can_write.clear()
+
+    def resume_writing(self) -> None:
+        self.can_write.set()
+
+    def error_received(self, exc: Exception) -> None:
+        print("WARN: OSC send failed:", exc)
+
+"""
+    Asyncio sender that pipelines packet production with sending:
+    - put()/put_all() hand packets to a background task. Once max_queued packets are waiting, they block the
+        producer until the task catches up (backpressure).
+    - The background task applies pacing, and also waits whenever the socket's own write buffer is full.
+    - put_all() yields to the loop after each packet, so sending starts while e.g. iter_queue_update_packets
+        is still building the later tracks.
+
+    async with AsyncOscSender("127.0.0.1", 13339, Pacing(max_bytes_per_second=4_000_000)) as sender:
+        await sender.put_all(get_configuration_messages(content))
+        for data in get_nrt_data(content, synthdefs, samples):
+            await sender.put_all(data.packets())
+"""
+@dataclass
+class AsyncOscSender:
+    host: str
+    port: int
+    pacing: Pacing = field(default_factory=Pacing)
+    max_queued: int = 256
+    _queue: asyncio.Queue | None = field(default=None, init=False, repr=False)
+    _transport: asyncio.DatagramTransport | None = field(default=None, init=False, repr=False)
+    _protocol: _SenderProtocol | None = field(default=None, init=False, repr=False)
+    _task: asyncio.Task | None = field(default=None, init=False, repr=False)
+
+    async def start(self):
+        family, address = _resolve_address(self.host, self.port)
+        loop = asyncio.get_running_loop()
+        self._transport, self._protocol = await loop.create_datagram_endpoint(_SenderProtocol, remote_addr=address, family=family)
+        self._queue = asyncio.Queue(self.max_queued)
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        assert self._queue != None and self._transport != None and self._protocol != None
+        while True:
+            dgram: bytes = await self._queue.get()
+            try:
+                wait = self.pacing.reserve(len(dgram))
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                await self._protocol.can_write.wait()
+                self._transport.sendto(dgram)
+            except Exception as e:
+                # Dropped like any other lost datagram; ending the task would leave drain() waiting forever
+                print("WARN: OSC send failed:", e)
+            finally:
+                self._queue.task_done()
+
+    async def put(self, packet: OscMessage | OscBundle):
+        if self._queue == None:
+            raise RuntimeError("AsyncOscSender has not been started")
+        await self._queue.put(packet.dgram)
+
+    async def put_all(self, packets: Iterable[OscMessage | OscBundle] | AsyncIterable[OscMessage | OscBundle]) -> int:
+        count = 0
+        if isinstance(packets, AsyncIterable):
+            async for packet in packets:
+                await self.put(packet)
+                count += 1
+        else:
+            for packet in packets:
+                await self.put(packet)
+                # Let the sender task run even while the queue has room
+                await asyncio.sleep(0)
+                count += 1
+        return count
+
+    # Waits until everything put so far has been handed to the socket
+    async def drain(self):
+        if self._queue != None:
+            await self._queue.join()
+
+    async def send_all(self, packets: Iterable[OscMessage | OscBundle] | AsyncIterable[OscMessage | OscBundle]) -> int:
+        count = await self.put_all(packets)
+        await self.drain()
+        return count
+
+    async def close(self):
+        await self.drain()
+        if self._task != None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._transport != None:
+            self._transport.close()
+        self._queue = None
+        self._transport = None
+        self._protocol = None
+        self._task = None
+
+    async def __aenter__(self) -> "AsyncOscSender":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+# Stand-in for jdw-sc in tests: collects every datagram sent to it on a background thread
+@dataclass
+class LoopbackReceiver:
+    host: str = "127.0.0.1"
+    port: int = 0 # 0 picks a free port, read it back after construction
+    receive_buffer_size: int = 0 # SO_RCVBUF, 0 keeps the system default
+    received: list[bytes] = field(default_factory=list)
+    _socket: socket.socket = field(init=False, repr=False)
+    _thread: threading.Thread = field(init=False, repr=False)
+    _condition: threading.Condition = field(default_factory=threading.Condition, init=False, repr=False)
+    _stopped: threading.Event = field(default_factory=threading.Event, init=False, repr=False)
+
+    def __post_init__(self):
+        family, address = _resolve_address(self.host, self.port)
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+        if self.receive_buffer_size > 0:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_size)
+        self._socket.bind(address)
+        self._socket.settimeout(0.05)
+        self.port = self._socket.getsockname()[1]
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                dgram = self._socket.recv(MAX_DATAGRAM_BYTES)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            with self._condition:
+                self.received.append(dgram)
+                self._condition.notify_all()
+
+    # Blocks until at least count datagrams have arrived (or the timeout passes) and returns a copy of them
+    def wait_for(self, count: int, timeout: float = 2.0) -> list[bytes]:
+        with self._condition:
+            self._condition.wait_for(lambda: len(self.received) >= count, timeout)
+            return list(self.received)
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        self._socket.close()
+
+    def __enter__(self) -> "LoopbackReceiver":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Tests
+if __name__ == "__main__":
+
+    from pythonosc import osc_message_builder
+
+    def msg(adr: str, args: list) -> OscMessage:
+        builder = osc_message_builder.OscMessageBuilder(address=adr)
+        for arg in args:
+            builder.add_arg(arg)
+        return builder.build()
+
+    packets = [msg("/note", [i, "x" * (i % 50)]) for i in range(2000)]
+
+    with LoopbackReceiver() as receiver, OscSender(receiver.host, receiver.port) as sender:
+        assert sender.send_all(packets[:10]) == 10
+        assert receiver.wait_for(10) == [p.dgram for p in packets[:10]]
+
+    pacing = Pacing(packet_interval_s=0.01)
+    assert pacing.reserve(10) == 0.0 and pacing.reserve(10) > 0.0
+
+    async def run_async():
+        # Small receive buffer: without pacing and backpressure some of these would be dropped
+        with LoopbackReceiver(receive_buffer_size=16384) as receiver:
+            async with AsyncOscSender(receiver.host, receiver.port, Pacing(max_bytes_per_second=200_000), max_queued=8) as sender:
+                assert await sender.send_all(packets) == len(packets)
+            assert receiver.wait_for(len(packets)) == [p.dgram for p in packets]
+
+    asyncio.run(run_async())
+
+    async def run_failing():
+        with LoopbackReceiver() as receiver:
+            async with AsyncOscSender(receiver.host, receiver.port) as sender:
+                def fail(dgram: bytes):
+                    raise OSError("unreachable")
+                sender._transport.sendto = fail # type: ignore
+                await asyncio.wait_for(sender.send_all(packets[:3]), 2.0)
+                await sender.put(packets[0])
+
+    asyncio.run(run_failing())
@@ -1,4 +1,8 @@
+import copy
+from functools import lru_cache
+
 from shuttle_notation.parsing.element import ResolvedElement
+from jdw_billboarding.lib.instrumentation import count_notes, timed
 from shuttle_notation.parsing.full_parse import Parser
 from shuttle_notation.parsing.information_parsing import DynamicArg
 
@@ -83,6 +87,7 @@ def parse_synth_header(content: str) -> SynthHeader:
         return SynthHeader(instrument_name, current_is_drone, current_is_sampler, is_selected, current_default_args_string, additional_config_string, current_group_name)
 
 
+@timed("parse_synth_chunk")
 def parse_synth_chunk(chunk: list[BillboardLine]) -> SynthSection:
 
     assert len(chunk) > 0, "Malformed synth chunk: no content"
@@ -113,15 +118,34 @@ def parse_synth_chunk(chunk: list[BillboardLine]) -> SynthSection:
 
 
 # Parse the shuttle string of the track, resolving any arg inheritance, returning the list of its elements
+@timed("parse_track", notes=count_notes)
 def parse_track(track: TrackDefinition, default_arg_string: str) -> list[ResolvedElement]:
+    # Copies, so that no caller can mutate the cached elements
+    return [_copy_element(element) for element in _parse_track_cached(track.content, default_arg_string, track.arg_override)]
+
+# Most tracks are unchanged between updates, so their parse results are kept by everything that affects them
+@lru_cache(maxsize=1024)
+def _parse_track_cached(content: str, default_arg_string: str, arg_override: str) -> tuple[ResolvedElement, ...]:
     # Easiest way to apply default args
-    full_source = "(" + track.content + "):" + default_arg_string if default_arg_string != "" else track.content
-    override_args = parse_args(track.arg_override, {})
+    full_source = "(" + content + "):" + default_arg_string if default_arg_string != "" else content
+    override_args = parse_args(arg_override, {})
     elements = Parser().parse(full_source)
 
     _arg_override(elements, override_args)
 
-    return elements
+    return tuple(elements)
+
+def _copy_element(element: ResolvedElement) -> ResolvedElement:
+    copied = copy.copy(element)
+    copied.args = dict(element.args)
+    return copied
+
+# Hits/misses/size of the parse_track cache
+def parse_track_cache_info():
+    return _parse_track_cached.cache_info()
+
+def clear_parse_track_cache():
+    _parse_track_cached.cache_clear()
 
 
 
@@ -157,4 +181,12 @@ if __name__ == "__main__":
     parse_synth_header("@SP_mysynth:group arg1,arg2,arg3 1:1 2:2 3:3")
     parse_track_definition("c4 g4 f2 x", 0)
     parse_effect_definition("€effect:req arg1,arg2,arg3")
-    parse_track(TrackDefinition("c4 c4 d4", "special", "sus4.0", 1), SynthHeader("synth", False, False, False, "arg2.0", "22:2", "group"))
+    parse_track(TrackDefinition("c4 c4 d4", "special", "sus4.0", 1), "arg2.0")
+
+    # Cached elements must survive callers mutating their copies
+    clear_parse_track_cache()
+    first = parse_track(TrackDefinition("c4 d4", "", "amp*2", 0), "amp0.5")
+    first[0].args["amp"] = 100
+    second = parse_track(TrackDefinition("c4 d4", "", "amp*2", 0), "amp0.5")
+    assert second[0].args["amp"] == 1, second[0].args
+    assert parse_track_cache_info().hits == 1 and parse_track_cache_info().misses == 1, parse_track_cache_info()